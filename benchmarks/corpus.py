@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Throughput of running a query over many independent roots, serially and in worker processes.
+
+Usage: python3 benchmarks/corpus.py [--roots N] [--workers N]
+"""
+import argparse
+import os
+import time
+
+from hiccup import Hiccup
+from hiccup.corpus import xquery_corpus
+
+
+def make_root(i: int):
+    # plain data, so it's cheap to pickle
+    return {
+        'title': 'file {}'.format(i),
+        'items': [{'heading': 'item {}'.format(j), 'tags': ['todo' if j % 7 == 0 else 'done', 'x']} for j in range(300)],
+    }
+
+
+QUERY = '//items/dict[./tags/primitivish[text()="todo"]]'
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--roots', type=int, default=500)
+    p.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = p.parse_args()
+
+    roots = [make_root(i) for i in range(args.roots)]
+
+    start = time.perf_counter()
+    h = Hiccup()
+    serial = sum(len(h.xquery(r, QUERY)) for r in roots)
+    base = time.perf_counter() - start
+    assert serial > 0, 'query has no results'
+    print('{:<20} {:.2f}s'.format('serial', base))
+
+    workers = 1
+    while workers <= args.workers:
+        start = time.perf_counter()
+        total = sum(len(res) for _, res in xquery_corpus(roots, QUERY, ordered=False, max_workers=workers))
+        took = time.perf_counter() - start
+        assert total == serial
+        print('{:<20} {:.2f}s (x{:.1f})'.format('{} workers'.format(workers), took, base / took))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Conversion time for very deep and very large objects.
+
+Usage: python3 benchmarks/deep.py [--recursionlimit N] [--against REV]
+
+--against REV: also runs the benchmark against the library as of git revision REV (e.g. the commit before a change),
+               so you get before/after numbers on the same machine
+"""
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from hiccup import Hiccup
+
+
+class Link:
+    def __init__(self, value, next) -> None:
+        self.value = value
+        self.next = next
+
+
+def deep(depth: int):
+    res = None
+    for i in range(depth):
+        res = Link(i, res)
+    return res
+
+
+def wide(nodes: int):
+    # each Link results in three elements
+    return [Link(i, None) for i in range(nodes // 3)]
+
+
+def measure(name: str, obj) -> None:
+    start = time.perf_counter()
+    try:
+        xml = Hiccup().as_xml(obj)
+        assert xml is not None
+        res = '{:.2f}s'.format(time.perf_counter() - start)
+    except RecursionError:
+        res = 'RecursionError'
+    print('{:<20} {}'.format(name, res))
+    sys.stdout.flush()
+
+
+def run_against(rev: str, recursionlimit) -> None:
+    """
+    Runs this script in a subprocess, with the library sources exported from git revision
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=here, universal_newlines=True).strip()
+    archive = subprocess.check_output(['git', 'archive', rev, 'src'], cwd=root)
+    with tempfile.TemporaryDirectory() as tmp:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(tmp)
+        env = dict(os.environ, PYTHONPATH=os.path.join(tmp, 'src'))
+        cmd = [sys.executable, os.path.abspath(__file__)]
+        if recursionlimit is not None:
+            cmd.extend(['--recursionlimit', str(recursionlimit)])
+        subprocess.run(cmd, env=env, check=True)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--recursionlimit', type=int, default=None)
+    p.add_argument('--against', metavar='REV', default=None)
+    args = p.parse_args()
+
+    if args.against is not None:
+        print('--- {}'.format(args.against))
+        sys.stdout.flush()
+        run_against(args.against, args.recursionlimit)
+        print('--- current')
+        sys.stdout.flush()
+
+    if args.recursionlimit is not None:
+        sys.setrecursionlimit(args.recursionlimit)
+
+    measure('deep 10k', deep(10000))
+    measure('wide 1M nodes', wide(1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for conversion and query hot paths on synthetic workloads.
+For each workload and phase, reports best wall time over the repeats and peak memory allocated during the phase.
+
+Usage:
+    python3 benchmarks/suite.py [--scale X] [--repeat N] [--only WORKLOAD ...] [--json results.json]
+    python3 benchmarks/suite.py --compare before.json after.json [--threshold 0.1]
+
+To compare commits, run the suite with --json on each of them, then --compare the files.
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from hiccup import Hiccup, myinspect, remove_control_characters
+
+
+Workload = NamedTuple('Workload', [
+    ('name', str),
+    ('make', Callable[[float], Any]), # scale -> object
+    ('query', str),
+])
+
+
+class Leaf:
+    def __init__(self, i: int) -> None:
+        self.value = i
+        self.name = 'leaf {}'.format(i)
+        self.flag = i % 2 == 0
+
+
+class Wide:
+    def __init__(self, n: int) -> None:
+        for i in range(n):
+            setattr(self, 'attr{}'.format(i), Leaf(i))
+
+
+class Node:
+    def __init__(self, value: int, child) -> None:
+        self.value = value
+        self.child = child
+
+
+class Props:
+    def __init__(self, i: int) -> None:
+        self._i = i
+
+    @property
+    def double(self) -> int:
+        return self._i * 2
+
+    @property
+    def text(self) -> str:
+        return 'item\x00{}'.format(self._i)
+
+    @property
+    def parity(self) -> str:
+        return 'even' if self._i % 2 == 0 else 'odd'
+
+    @property
+    def tags(self) -> List[str]:
+        return ['a', 'b']
+
+
+class Heading:
+    def __init__(self, level: int, title: str, tags: List[str], body: str, children: List['Heading']) -> None:
+        self.level = level
+        self.title = title
+        self.tags = tags
+        self.body = body
+        self.children = children
+
+
+def wide(scale: float):
+    return Wide(int(20000 * scale))
+
+
+def deep(scale: float):
+    res = None
+    for i in range(int(5000 * scale)):
+        res = Node(i, res)
+    return res
+
+
+def json_like(scale: float):
+    return {
+        'users': [{
+            'id': i,
+            'name': 'user{}'.format(i),
+            'address': {'city': 'city{}'.format(i % 50), 'zip': str(10000 + i)},
+            'scores': [i % 7, i % 11, i % 13],
+            'active': i % 3 == 0,
+        } for i in range(int(10000 * scale))],
+    }
+
+
+def primitives(scale: float):
+    return list(range(int(200000 * scale)))
+
+
+def properties(scale: float):
+    return [Props(i) for i in range(int(20000 * scale))]
+
+
+def outline(scale: float):
+    def make(level: int, prefix: str, count: int) -> List[Heading]:
+        return [Heading(
+            level=level,
+            title='{}TODO heading {}'.format('' if i % 5 else 'DONE ', prefix + str(i)),
+            tags=['work'] if i % 4 == 0 else [],
+            body='some text\nwith\tcontrol characters ✓ {}'.format(i),
+            children=make(level + 1, prefix + str(i) + '.', count) if level < 4 else [],
+        ) for i in range(count)]
+    return make(1, '', max(int(10 * scale ** 0.25), 1))
+
+
+WORKLOADS = [
+    # note that elements of objects stored in attributes are named after the attribute rather than the type
+    Workload('wide'      , wide      , '//Wide/*[./flag[text()="true"]]'),
+    Workload('deep'      , deep      , '//child[./value[text()="42"]]'),
+    Workload('json'      , json_like , '//users/dict[./address/city[text()="city7"]]'),
+    Workload('primitives', primitives, '//primitivish[text()="123"]'),
+    Workload('properties', properties, '//Props[./parity[text()="even"]]'),
+    Workload('outline'   , outline   , '//Heading[./tags/primitivish[text()="work"]]'),
+]
+
+
+def phases(w: Workload, scale: float) -> List[Tuple[str, Callable[[], Any]]]:
+    """
+    Each phase is a function which does the measured work. Setup isn't measured.
+    Phases only go through the public API, so the suite can run against older revisions too
+    """
+    h = Hiccup()
+    obj = w.make(scale)
+    snap = h.snapshot(obj)
+    if len(snap.xquery(w.query)) == 0:
+        # otherwise we'd be timing a query which doesn't do much
+        raise RuntimeError('{}: query {} has no results'.format(w.name, w.query))
+    objects = h.xquery(obj, '//*')
+    strings = [o for o in objects if isinstance(o, str)]
+    plain = [o for o in objects if hasattr(o, '__dict__')]
+
+    def members():
+        # same as conversion does, minus exclusion rules
+        for o in plain:
+            myinspect.getmembers(o, [(None, o)], lambda path: False)
+
+    res = [
+        ('make'        , lambda: w.make(scale)),
+        ('convert'     , lambda: h.as_xml(obj)),
+        ('snapshot'    , lambda: h.snapshot(obj).close()),
+        ('query'       , lambda: snap.xquery(w.query)),
+        ('members'     , members),
+        ('control_chars', lambda: [remove_control_characters(s) for s in strings]),
+    ] # type: List[Tuple[str, Callable[[], Any]]]
+
+    # internal, skipped if it's not there
+    is_excluded = getattr(h, '_is_excluded', None)
+    if is_excluded is not None:
+        contexts = [[('parent', objects[0]), (type(o).__name__, o)] for o in objects]
+        res.insert(5, ('is_excluded', lambda: [is_excluded(c) for c in contexts]))
+    return res
+
+
+Results = Dict[str, Dict[str, Dict[str, float]]] # workload -> phase -> metric -> value
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    # separate run, tracemalloc slows things down quite a bit
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': best, 'peak_mb': peak / 2 ** 20}
+
+
+def run(scale: float, repeat: int, only: List[str]) -> Results:
+    res = {} # type: Results
+    for w in WORKLOADS:
+        if len(only) > 0 and w.name not in only:
+            continue
+        res[w.name] = {}
+        for phase, fn in phases(w, scale):
+            m = measure(fn, repeat)
+            res[w.name][phase] = m
+            print('{:<12} {:<14} {:>9.4f}s {:>9.1f}MB'.format(w.name, phase, m['time'], m['peak_mb']))
+            sys.stdout.flush()
+    return res
+
+
+def compare(before: Results, after: Results, threshold: float) -> bool:
+    """
+    Returns False if anything got slower (or more memory hungry) by more than threshold
+    """
+    ok = True
+    for wname, ph in sorted(after.items()):
+        for phase, m in sorted(ph.items()):
+            old = before.get(wname, {}).get(phase, None)
+            if old is None:
+                continue
+            line = '{:<12} {:<14}'.format(wname, phase)
+            for metric in ('time', 'peak_mb'):
+                # ignore noise on tiny values
+                base = max(old[metric], 1e-3)
+                ratio = m[metric] / base
+                flag = ''
+                if ratio > 1 + threshold and m[metric] - old[metric] > 1e-3:
+                    flag = ' !!'
+                    ok = False
+                line += ' {:>8}: {:>9.4f} -> {:>9.4f} (x{:.2f}){:<3}'.format(metric, old[metric], m[metric], ratio, flag)
+            print(line)
+    return ok
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--scale', type=float, default=1.0, help='multiplier for workload sizes')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--only', nargs='*', default=[], choices=[w.name for w in WORKLOADS])
+    p.add_argument('--json', help='file to write results to')
+    p.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    p.add_argument('--threshold', type=float, default=0.1, help='relative slowdown to report as regression')
+    args = p.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as fo:
+            before = json.load(fo)
+        with open(args.compare[1]) as fo:
+            after = json.load(fo)
+        sys.exit(0 if compare(before['results'], after['results'], args.threshold) else 1)
+
+    res = run(scale=args.scale, repeat=args.repeat, only=args.only)
+    if args.json is not None:
+        with open(args.json, 'w') as fo:
+            json.dump({
+                'scale': args.scale,
+                'python': sys.version,
+                'results': res,
+            }, fo, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
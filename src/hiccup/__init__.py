@@ -15,27 +15,48 @@ __copyright__ = "Dima Gerasimov"
 __license__ = "mit"
 
 
-import inspect
-import ctypes
+import array
+import bisect
 import re
-from typing import Any, List, Dict, Type, Optional, Set, Tuple, Callable
+import types
+import weakref
+from time import monotonic, perf_counter
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, List, Dict, Type, Optional, Set, Tuple, Callable, Iterable, Iterator
 import unicodedata
 
 # pylint: disable=import-error
 from lxml import etree as ET
 
 from . import myinspect
+from .query import analyze, QueryAnalysis
 
 
-def di(id_: int) -> Any:
-    """
-    Hacky inverse for id
-    """
-    return ctypes.cast(id_, ctypes.py_object).value # type: ignore
+def _is_control(ch: str) -> bool:
+    return unicodedata.category(ch)[0] == "C"
+
 
+_ASCII_CONTROL = {i: None for i in range(128) if _is_control(chr(i))} # type: Dict[int, None]
+_control_cache = {} # type: Dict[str, bool]
+_isascii = getattr(str, 'isascii', None) # python3.7+
 
-def remove_control_characters(s):
-    return "".join(ch for ch in s if unicodedata.category(ch)[0]!="C")
+
+def remove_control_characters(s: str) -> str:
+    if _isascii is not None and _isascii(s):
+        return s.translate(_ASCII_CONTROL)
+
+    bad = []
+    for ch in set(s):
+        res = _control_cache.get(ch, None)
+        if res is None:
+            res = _is_control(ch)
+            _control_cache[ch] = res
+        if res:
+            bad.append(ch)
+    if len(bad) == 0:
+        return s
+    return s.translate({ord(ch): None for ch in bad})
 
 
 class HiccupError(RuntimeError):
@@ -50,46 +71,217 @@ Context = List[Tuple[Optional[AttrName], Any]] # 'path' to the object, including
 Result = Any
 
 Check = Callable[[Context], bool]
+Child = Tuple[Optional[AttrName], Any, bool]
+Kind = Tuple[str, Any, str]
+# how objects of some type are converted: kind, primitive converter and the tag
+Plan = Tuple[str, Optional[Callable[[Any], str]], str]
+# items of the compacted sequence, along with Hiccup to convert them
+Compact = Tuple[Any, 'Hiccup']
+
 
-def IfType(cls: Type[Any]) -> Check:
-    def check(ctx: Context) -> bool:
+class IfType:
+    """
+    Checks are plain callables, classes here are just to let the exclusion rules engine index them
+    """
+    static = False # whether the result only depends on the attribute name and the type of its parent
+
+    def __init__(self, cls: Type[Any]) -> None:
+        self.cls = cls
+
+    def __call__(self, ctx: Context) -> bool:
         me = ctx[-1]
-        return type(me[1]) == cls
-    return check
+        return type(me[1]) == self.cls
+
+    def __repr__(self) -> str:
+        return 'IfType({})'.format(self.cls.__name__)
 
+    def __reduce__(self) -> Any:
+        # some of the builtin types (e.g. types.MethodType) can't be pickled by reference, but they can be found in types module
+        name = _TYPES_NAMES.get(self.cls, None)
+        if name is not None:
+            return (_if_builtin_type, (name,))
+        return (IfType, (self.cls,))
 
-def IfParentType(cls: Type[Any]) -> Check:
-    def check(ctx: Context) -> bool:
+
+_TYPES_NAMES = {v: k for k, v in sorted(vars(types).items()) if isinstance(v, type)} # type: Dict[type, str]
+
+
+def _if_builtin_type(name: str) -> IfType:
+    return IfType(getattr(types, name))
+
+
+class IfParentType:
+    static = True
+
+    def __init__(self, cls: Type[Any]) -> None:
+        self.cls = cls
+
+    def __call__(self, ctx: Context) -> bool:
         if len(ctx) < 2:
             return False
         p = ctx[-2]
-        return type(p[1]) == cls
-    return check
+        return type(p[1]) == self.cls
+
+    def __repr__(self) -> str:
+        return 'IfParentType({})'.format(self.cls.__name__)
+
 
+class IfName:
+    static = True
 
-def IfName(name: AttrName) -> Check:
-    def check(ctx: Context) -> bool:
+    def __init__(self, name: AttrName) -> None:
+        self.name = name
+
+    def __call__(self, ctx: Context) -> bool:
         p = ctx[-1]
-        return p[0] == name
-    return check
+        return p[0] == self.name
+
+    def __repr__(self) -> str:
+        return 'IfName({!r})'.format(self.name)
 
 
-def IfNameMatches(regex) -> Check:
-    def check(ctx: Context) -> bool:
+class IfNameMatches:
+    static = True
+
+    def __init__(self, regex) -> None:
+        self.regex = regex
+        self.pattern = re.compile(regex)
+
+    def __call__(self, ctx: Context) -> bool:
         p = ctx[-1]
         name = p[0]
         if name is None:
             return False
-        return re.fullmatch(regex, name) is not None
-    return check
+        return self.pattern.fullmatch(name) is not None
+
+    def __repr__(self) -> str:
+        return 'IfNameMatches({!r})'.format(self.pattern.pattern)
 
 
-def IfValueMatches(predicate: Callable[[Any], bool]) -> Check:
-    def check(ctx: Context) -> bool:
+class IfValueMatches:
+    static = False
+
+    def __init__(self, predicate: Callable[[Any], bool]) -> None:
+        self.predicate = predicate
+
+    def __call__(self, ctx: Context) -> bool:
         p = ctx[-1]
         value = p[1]
-        return predicate(value)
-    return check
+        return self.predicate(value)
+
+    def __repr__(self) -> str:
+        return 'IfValueMatches({})'.format(getattr(self.predicate, '__name__', self.predicate))
+
+
+Rule = Tuple[Check, ...] # all checks have to match for the rule to match
+
+
+def _describe(rule: Rule) -> str:
+    return ' & '.join(repr(c) for c in rule)
+
+
+def _is_static(rule: Rule) -> bool:
+    return all(getattr(c, 'static', False) for c in rule)
+
+
+_DEFAULT_FLAGS = re.compile('').flags
+
+
+class _CompiledRules:
+    """
+    Indexes rules by the attribute name, parent type and type, so only the rules which can possibly match are evaluated.
+    Rules consisting of a single name regex (without flags) are merged in a single regex.
+    Rules we don't know how to index (e.g. arbitrary callables) are just evaluated one by one.
+    """
+    def __init__(self, rules: List[Rule]) -> None:
+        self.by_name = {} # type: Dict[AttrName, List[Rule]]
+        self.by_parent_type = {} # type: Dict[Type[Any], List[Rule]]
+        self.by_type = {} # type: Dict[Type[Any], List[Rule]]
+        self.by_regex = [] # type: List[Tuple[Any, Rule]]
+        self.other = [] # type: List[Rule]
+
+        alternatives = [] # type: List[str]
+        for rule in rules:
+            key = self._index_key(rule)
+            if key is None:
+                self.other.append(rule)
+                continue
+            rest = tuple(c for c in rule if c is not key)
+            if isinstance(key, IfName):
+                self.by_name.setdefault(key.name, []).append(rest)
+            elif isinstance(key, IfParentType):
+                self.by_parent_type.setdefault(key.cls, []).append(rest)
+            elif isinstance(key, IfType):
+                self.by_type.setdefault(key.cls, []).append(rest)
+            elif len(rest) == 0 and key.pattern.groups == 0 and isinstance(key.regex, str) \
+                    and key.pattern.flags == _DEFAULT_FLAGS and not key.regex.startswith('(?'):
+                # no groups, so no backreferences that would break in the alternation. Inline flags are only allowed at the start
+                alternatives.append(key.regex)
+            else:
+                self.by_regex.append((key.pattern, rest))
+        self.name_regex = None if len(alternatives) == 0 else re.compile('|'.join('(?:{})'.format(a) for a in alternatives))
+        self.key = self._stable_key(rules)
+
+    @staticmethod
+    def _stable_key(rules: List[Rule]) -> Optional[Tuple[Any, ...]]:
+        """
+        Identifies the rules across Hiccup instances, so results cached for them in class layouts (see myinspect.Schema) can be shared.
+        None if there are checks we don't know anything about
+        """
+        res = [] # type: List[Tuple[Any, ...]]
+        for rule in rules:
+            key = [] # type: List[Any]
+            for c in rule:
+                tc = type(c)
+                if tc is IfName:
+                    key.append(('name', c.name)) # type: ignore
+                elif tc is IfNameMatches:
+                    key.append(('regex', c.pattern.pattern, c.pattern.flags)) # type: ignore
+                elif tc is IfType or tc is IfParentType:
+                    # ids of live classes are unique, and these checks only matter for the layout of the class itself
+                    key.append((tc.__name__, id(c.cls))) # type: ignore
+                else:
+                    return None
+            res.append(tuple(key))
+        return tuple(res)
+
+    @staticmethod
+    def _index_key(rule: Rule) -> Any:
+        for cls in (IfName, IfParentType, IfType, IfNameMatches):
+            for c in rule:
+                if type(c) == cls:
+                    return c
+        return None
+
+    @staticmethod
+    def _any(rules: List[Rule], ctx: Context) -> bool:
+        for rule in rules:
+            for c in rule:
+                if not c(ctx):
+                    break
+            else:
+                return True
+        return False
+
+    def matches(self, ctx: Context) -> bool:
+        name, value = ctx[-1]
+        if name is not None:
+            if self.name_regex is not None and self.name_regex.fullmatch(name) is not None:
+                return True
+            rules = self.by_name.get(name, None)
+            if rules is not None and self._any(rules, ctx):
+                return True
+            for pattern, rest in self.by_regex:
+                if pattern.fullmatch(name) is not None and self._any([rest], ctx):
+                    return True
+        if len(ctx) >= 2:
+            rules = self.by_parent_type.get(type(ctx[-2][1]), None)
+            if rules is not None and self._any(rules, ctx):
+                return True
+        rules = self.by_type.get(type(value), None)
+        if rules is not None and self._any(rules, ctx):
+            return True
+        return self._any(self.other, ctx)
 
 
 class TypeNameMap:
@@ -112,15 +304,25 @@ class PrimitiveFactory:
         """
         raise NotImplementedError
 
+
+# module level rather than lambdas, so factories can be pickled (e.g. to send configuration to worker processes)
+def _none_as_primitive(x: None) -> str:
+    return 'none'
+
+
+def _bool_as_primitive(x: bool) -> str:
+    return 'true' if x else 'false'
+
+
 class DefaultPrimitiveFactory(PrimitiveFactory):
     def __init__(self) -> None:
         self.converters = {
-            type(None): lambda x: 'none',
-            bool      : lambda x: 'true' if x else 'false',
-            int       : lambda x: str(x),
-            float     : lambda x: str(x),
-            str       : lambda x: remove_control_characters(x),
-        }
+            type(None): _none_as_primitive,
+            bool      : _bool_as_primitive,
+            int       : str,
+            float     : str,
+            str       : remove_control_characters,
+        } # type: Dict[Type[Any], Callable[[Any], str]]
 
     def as_primitive(self, obj: Any) -> Optional[str]:
         conv = self.converters.get(type(obj), None)
@@ -159,11 +361,369 @@ class DefaultDictFactory:
         return obj
 
 
+class XPathCache:
+    """
+    Bounded LRU cache of compiled xpath expressions
+    """
+    def __init__(self, maxsize: int=256) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict() # type: OrderedDict
+
+    @staticmethod
+    def _freeze(x: Any) -> Any:
+        if x is None:
+            return None
+        if isinstance(x, dict):
+            return frozenset(x.items())
+        # lxml also accepts a list of extension dicts
+        return tuple(XPathCache._freeze(d) for d in x)
+
+    def get(self, query: Xpath, namespaces=None, extensions=None) -> ET.XPath:
+        key = (query, self._freeze(namespaces), self._freeze(extensions))
+        res = self._cache.get(key, None)
+        if res is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return res
+
+        self.misses += 1
+        res = ET.XPath(query, namespaces=namespaces, extensions=extensions)
+        if self.maxsize > 0:
+            self._cache[key] = res
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return res
+
+    def prewarm(self, queries: Iterable[Xpath], namespaces=None, extensions=None) -> None:
+        """
+        Compiles queries known in advance, e.g. at startup.
+        Namespaces and extensions have to be the same as in the queries later on, so you probably want Hiccup.prewarm instead
+        """
+        for q in queries:
+            self.get(q, namespaces=namespaces, extensions=extensions)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class ValueCache:
+    """
+    Attribute values keyed by object identity and attribute name, see Hiccup.memoize.
+    Entries are dropped when the object is garbage collected, so objects have to support weak references (otherwise values aren't cached).
+    Least recently used entries are evicted when there are more than maxsize, and entries older than ttl seconds are recomputed.
+    """
+    def __init__(self, maxsize: int=100000, ttl: Optional[float]=None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # (object id, attribute) -> (value, time it was computed)
+        self._entries = OrderedDict() # type: OrderedDict
+        # object id -> weak reference, which drops the object's entries once it's gone
+        self._refs = {} # type: Dict[int, weakref.ref]
+        self._names = {} # type: Dict[int, Set[AttrName]]
+
+    def get(self, obj: Any, name: AttrName, compute: Callable[[], Any]) -> Any:
+        oid = id(obj)
+        key = (oid, name)
+        entry = self._entries.get(key, None)
+        if entry is not None and (self.ttl is None or monotonic() - entry[1] <= self.ttl):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        value = compute()
+        if oid not in self._refs:
+            try:
+                self._refs[oid] = weakref.ref(obj, self._dropper(oid))
+            except TypeError:
+                # can't tell when the object dies, so caching by id isn't safe
+                return value
+        self._entries[key] = (value, monotonic())
+        self._entries.move_to_end(key)
+        self._names.setdefault(oid, set()).add(name)
+        while len(self._entries) > self.maxsize:
+            (eoid, ename), _ = self._entries.popitem(last=False)
+            self._forget(eoid, ename)
+        return value
+
+    def _dropper(self, oid: int) -> Callable[[Any], None]:
+        def drop(_ref) -> None:
+            for name in self._names.pop(oid, ()):
+                self._entries.pop((oid, name), None)
+            self._refs.pop(oid, None)
+        return drop
+
+    def _forget(self, oid: int, name: AttrName) -> None:
+        names = self._names.get(oid, None)
+        if names is None:
+            return
+        names.discard(name)
+        if len(names) == 0:
+            del self._names[oid]
+            del self._refs[oid]
+
+    def invalidate(self, obj: Any, name: Optional[AttrName]=None) -> None:
+        """
+        Drops cached values of the object (or just of the attribute), e.g. if you know it's changed
+        """
+        oid = id(obj)
+        names = [name] if name is not None else list(self._names.get(oid, ()))
+        for n in names:
+            if self._entries.pop((oid, n), None) is not None:
+                self._forget(oid, n)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._refs.clear()
+        self._names.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # cached values are only meaningful within the process
+        return {'maxsize': self.maxsize, 'ttl': self.ttl}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(**state) # type: ignore
+
+
+class Limits:
+    """
+    Parts of the object graph conversion is allowed to skip, as long as it doesn't change the query results
+    """
+    def __init__(self, max_depth: Optional[int]=None, names: Optional[Set[str]]=None, prune_members: bool=False) -> None:
+        """
+        max_depth: elements at that depth aren't expanded, so no element is deeper than it (root element has depth 1)
+        names: elements with other names are pruned, as long as they're primitive
+        prune_members: prune all elements with other names (including non-primitive), without even evaluating them
+        """
+        self.max_depth = max_depth
+        self.names = names
+        self.prune_members = prune_members
+
+    def expands(self, depth: int) -> bool:
+        return self.max_depth is None or depth < self.max_depth
+
+    def prunes(self, tag: str, leaf: bool) -> bool:
+        return self.names is not None and tag not in self.names and (leaf or self.prune_members)
+
+    def covers(self, q: QueryAnalysis) -> bool:
+        """
+        Whether the query can be answered from xml converted with these limits
+        """
+        if self.max_depth is not None and (q.max_depth is None or q.max_depth > self.max_depth):
+            return False
+        if self.names is not None:
+            if q.names is None or not q.names.issubset(self.names):
+                return False
+            if self.prune_members and q.max_depth is None:
+                return False
+        return True
+
+
+class Budget:
+    """
+    Bounds on the conversion work, in case the object turns out unexpectedly large.
+    Unlike Limits, budgets do change the results: the elements where conversion stopped get Hiccup.truncated_attr set to the reason
+    """
+    def __init__(
+            self,
+            max_nodes: Optional[int]=None,
+            max_depth: Optional[int]=None,
+            max_items: Optional[int]=None,
+            deadline: Optional[float]=None,
+            partial: bool=False,
+    ) -> None:
+        """
+        max_nodes: total number of elements ('nodes')
+        max_depth: elements at that depth aren't expanded, so no element is deeper than it. Root element has depth 1 ('depth')
+        max_items: only the first max_items items of lists and dicts are converted ('items')
+        deadline: seconds the conversion is allowed to take ('deadline')
+        partial: return partial results instead of raising HiccupError when the budget is exceeded
+        """
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.deadline = deadline
+        self.partial = partial
+
+
+class Stats:
+    """
+    Profiling information, collected if Hiccup.profile is set (or via Hiccup.xquery_stats)
+    """
+    def __init__(self) -> None:
+        """
+        Seconds spent in each phase. Phases are nested, e.g. 'members' is a part of 'convert'
+        - convert: building xml
+        - members: extracting attributes of objects, including getattr and exclusion of members
+        - getattr: getting attribute values, e.g. evaluating properties
+        - exclusion: checking exclusion rules
+        - hook: xml_hook
+        - xpath: evaluating queries
+        - map: mapping result elements back to objects
+        """
+        self.phases = {} # type: Dict[str, float]
+        self.elements = 0
+        self.attributes = 0
+        self.excluded = 0
+        self.queries = 0
+        """
+        (type name, attribute) -> number of times it was fetched and total seconds
+        """
+        self.getattrs = {} # type: Dict[Tuple[str, AttrName], List[float]]
+        """
+        Description of exclusion rule -> number of times it excluded something
+        """
+        self.rule_hits = {} # type: Dict[str, int]
+
+    def _add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def _getattr(self, tname: str, name: AttrName, seconds: float) -> None:
+        cur = self.getattrs.get((tname, name), None)
+        if cur is None:
+            self.getattrs[(tname, name)] = [1, seconds]
+        else:
+            cur[0] += 1
+            cur[1] += seconds
+
+    def by_type(self) -> Dict[str, float]:
+        """
+        Total getattr time per type
+        """
+        res = {} # type: Dict[str, float]
+        for (tname, _), (_, seconds) in self.getattrs.items():
+            res[tname] = res.get(tname, 0.0) + seconds
+        return res
+
+    def slowest_attributes(self, n: int=10) -> List[Tuple[Tuple[str, AttrName], float]]:
+        """
+        Attributes which took the most time to get in total, e.g. expensive properties
+        """
+        return sorted(((k, v[1]) for k, v in self.getattrs.items()), key=lambda p: p[1], reverse=True)[:n]
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Flat representation, e.g. to export as metrics
+        """
+        res = {
+            'elements'  : self.elements,
+            'attributes': self.attributes,
+            'excluded'  : self.excluded,
+            'queries'   : self.queries,
+        } # type: Dict[str, Any]
+        for phase, seconds in self.phases.items():
+            res['time.' + phase] = seconds
+        for (tname, name), (count, seconds) in self.getattrs.items():
+            res['getattr.{}.{}.count'.format(tname, name)] = count
+            res['getattr.{}.{}.time'.format(tname, name)] = seconds
+        for rule, count in self.rule_hits.items():
+            res['rule.' + rule] = count
+        return res
+
+
+class _Conversion:
+    """
+    State of a single as_xml call
+    """
+    def __init__(self, limits: Limits, stats: Optional[Stats]=None, plans: Optional[Dict[Type[Any], Plan]]=None) -> None:
+        self.limits = limits
+        self.stats = stats
+        """
+        Per type dispatch, None if it can't be decided by type alone (i.e. custom factories are used)
+        """
+        self.plans = plans
+        """
+        Maps elements back to objects. Also necessary to prevent temporaries from being GC'ed (and their ids reused)
+        while converting/querying
+        """
+        self.elements = {} # type: Dict[ET.Element, Any]
+        self.on_path = set() # type: Set[int]
+        self.converted = set() # type: Set[int]
+        self.compact = {} # type: Dict[ET.Element, Compact]
+        self.budget = None # type: Optional[Budget]
+        self.nodes = 0
+        self.deadline = None # type: Optional[float]
+        self.truncated = False
+
+    def start(self, budget: Optional[Budget]) -> None:
+        self.budget = budget
+        self.deadline = None if budget is None or budget.deadline is None else monotonic() + budget.deadline
+
+    def exceeded(self) -> Optional[str]:
+        """
+        Reason if the budget for the whole conversion is exhausted
+        """
+        budget = self.budget
+        if budget is None:
+            return None
+        if budget.max_nodes is not None and self.nodes >= budget.max_nodes:
+            return 'nodes'
+        if self.deadline is not None and monotonic() > self.deadline:
+            return 'deadline'
+        return None
+
+
+# conversions with compacted sequences, so hiccup:item() can find the items
+_compact_conversions = weakref.WeakSet() # type: weakref.WeakSet
+
+HICCUP_NS = 'https://github.com/karlicoss/hiccup'
+
+
+def _item(context, nodes, index) -> Any:
+    """
+    hiccup:item(node, i): text of i-th (starting from 1, as usual in xpath) item of the compacted sequence
+    """
+    nodes = nodes if isinstance(nodes, list) else [nodes]
+    if len(nodes) == 0 or not isinstance(nodes[0], ET._Element):
+        return []
+    el = nodes[0]
+    for conv in list(_compact_conversions):
+        compact = conv.compact.get(el, None)
+        if compact is None:
+            continue
+        items, h = compact
+        i = int(index)
+        if i != index or not 1 <= i <= len(items):
+            return []
+        return h._kind(items[i - 1], conv.plans)[1]
+    return []
+
+
+_COMPACT_EXTENSIONS = {(HICCUP_NS, 'item'): _item}
+
+
+def _per_type(cache: weakref.WeakKeyDictionary, tp: Type[Any]) -> Dict[AttrName, bool]:
+    res = cache.get(tp, None)
+    if res is None:
+        res = {}
+        cache[tp] = res
+    return res
+
+
 class Hiccup:
     def __init__(self) -> None:
-        self._object_keeper = {} # type: Dict[int, Any]
-        self._exclude = [] # type: List[Tuple[Check]]
-        self.python_id_attr = '_python_id'
+        self._snapshots = weakref.WeakSet() # type: weakref.WeakSet
+        self._exclude = [] # type: List[Rule]
+        self._compiled = None # type: Optional[Tuple[_CompiledRules, _CompiledRules, _CompiledRules]]
+        # type -> attribute name -> result of static rules. Weak, so classes created on the fly can be collected
+        self._static_excluded = weakref.WeakKeyDictionary() # type: weakref.WeakKeyDictionary
+        """
+        Attribute to store id() of the corresponding object in. Not necessary for mapping elements to objects,
+        so can be set to None to save some memory
+        """
+        self.python_id_attr = '_python_id' # type: Optional[str]
         self.primitive_factory = DefaultPrimitiveFactory()
         self.list_factory = DefaultListFactory()
         self.dict_factory = DefaultDictFactory()
@@ -172,115 +732,648 @@ class Hiccup:
         Does some final rewriting of xml to query on
         """
         self.xml_hook = None # type: Optional[Callable[[ET], None]]
+        self.xpath_namespaces = None # type: Optional[Dict[str, str]]
+        self.xpath_extensions = None # type: Optional[Dict[Tuple[Optional[str], str], Callable]]
+        self.xpath_cache = XPathCache()
+        """
+        Only convert the parts of the object the query can reach (as far as static analysis of the query can tell)
+        """
+        self.lazy = False
+        """
+        Skip elements which can't possibly match the query, based on the element names it mentions
+        """
+        self.prune = False
+        """
+        How to deal with objects encountered more than once during conversion:
+        - None: convert them every time. Reference cycles have to be excluded manually, otherwise conversion raises HiccupError
+        - 'cycles': objects already on the path from the root are emitted as references, to break cycles
+        - 'shared': all objects converted before are emitted as references, so each object is only converted once
+        References are elements with no children and ref_attr attribute set.
+        """
+        self.dedup = None # type: Optional[str]
+        self.ref_attr = '_ref'
+        """
+        Answer queries like //tag, //tag[text()="value"] and //tag[starts-with(text(), "prefix")] from an index of element names and texts,
+        built by the snapshot on first use. Other queries are evaluated by lxml as usual
+        """
+        self.value_index = False
+        """
+        Collect profiling information (see Stats) for each snapshot, it's available as Snapshot.stats.
+        stats_hook is called with it when the snapshot is closed (for one-shot queries, right after the query)
+        """
+        self.profile = False
+        self.stats_hook = None # type: Optional[Callable[[Stats], None]]
+        """
+        For dataclasses, attrs classes, namedtuples and classes with __slots__ (and no __dict__),
+        only convert the declared fields instead of inspecting everything dir() returns.
+        Note that namedtuples are then converted as objects rather than lists.
+        field_properties: along with the fields, convert properties of such classes
+        """
+        self.fields_only = False
+        self.field_properties = True
+        """
+        Lists and array.array objects of at least that many items, all of the same primitive type,
+        are converted into a single element with a summary instead of an element per item:
+        length and itemtype attributes, and min/max for numbers.
+        Items are still available in queries on snapshots via hiccup:item(node, i), e.g. //readings[hiccup:item(., 1) > 10]
+        """
+        self.compact_sequences = None # type: Optional[int]
+        """
+        Bounds on conversion work, see Budget. Elements where conversion stopped get truncated_attr set,
+        and Snapshot.truncated tells whether the results are partial
+        """
+        self.budget = None # type: Optional[Budget]
+        self.truncated_attr = '_truncated'
+        """
+        Values of the attributes matching memoize() rules are kept here across conversions
+        """
+        self.value_cache = ValueCache()
+        self._memoize = [] # type: List[Rule]
+        self._memoize_compiled = None # type: Optional[_CompiledRules]
+        self._memoized = weakref.WeakKeyDictionary() # type: weakref.WeakKeyDictionary
         self._exclude.extend(Hiccup.default_excludes())
 
     @staticmethod
     def default_excludes():
         return [
             (IfNameMatches('__.*'),),
-            (IfValueMatches(lambda x: inspect.ismethod(x) or inspect.isfunction(x)), ),
+            # same as inspect.ismethod/isfunction (these types can't be subclassed), but indexed by type
+            (IfType(types.MethodType), ),
+            (IfType(types.FunctionType), ),
         ]
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # snapshots, compiled xpaths and memoized rule results are local to the process
+        state = self.__dict__.copy()
+        del state['_snapshots']
+        del state['_static_excluded']
+        del state['_memoized']
+        state['_compiled'] = None
+        state['_memoize_compiled'] = None
+        state['xpath_cache'] = XPathCache(maxsize=self.xpath_cache.maxsize)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._snapshots = weakref.WeakSet()
+        self._static_excluded = weakref.WeakKeyDictionary()
+        self._memoized = weakref.WeakKeyDictionary()
+
     def exclude(self, *conditions) -> None:
         """
         Excludes the thing respecting all of these predicates from xml converstion. Helpful to eliminate recursion.
         """
-        self._exclude.append(conditions) # type: ignore
+        self._exclude.append(conditions)
+        self._compiled = None
+        self._static_excluded.clear()
 
-    # TODO rename Context to Path?
-    def _get_attributes(self, obj: Any, path: Context) -> List[Tuple[AttrName, Any]]:
-        # TODO shit. inspect may result in exception even though we weren't intending to looking at the value :(
-        return myinspect.getmembers(obj, path=path, excluded=self._is_excluded)
+    def memoize(self, *conditions) -> None:
+        """
+        Caches values of the attributes respecting all of these predicates in value_cache, so they aren't recomputed on every conversion
+        (e.g. expensive properties). Cached values aren't updated when objects change, use value_cache.invalidate for that.
 
-    def _keep(self, obj: Any):
+        Only checks depending on attribute name and parent type are supported (IfName, IfNameMatches, IfParentType),
+        since they are evaluated before getting the value.
         """
-        Necessary to prevent temporaries from being GC'ed while querying
+        if not _is_static(conditions):
+            raise HiccupError('{}: only IfName, IfNameMatches and IfParentType are supported'.format(_describe(conditions)))
+        self._memoize.append(conditions)
+        self._memoize_compiled = None
+        self._memoized.clear()
+
+    def _value_getter(self, obj: Any, path: Context) -> Optional[Callable[[Any, AttrName, Callable[[], Any]], Any]]:
+        if len(self._memoize) == 0:
+            return None
+        if self._memoize_compiled is None:
+            self._memoize_compiled = _CompiledRules(self._memoize)
+        rules = self._memoize_compiled
+        memoized_names = _per_type(self._memoized, type(obj))
+        # rules are static, so they only look at the attribute and the object it belongs to
+        me = path[-1]
+
+        def get(o: Any, name: AttrName, compute: Callable[[], Any]) -> Any:
+            memoized = memoized_names.get(name, None)
+            if memoized is None:
+                memoized = rules.matches([me, (name, myinspect._inprogress)])
+                memoized_names[name] = memoized
+            if not memoized:
+                return compute()
+            return self.value_cache.get(o, name, compute)
+        return get
+
+    def _rules(self) -> Tuple[_CompiledRules, _CompiledRules, _CompiledRules]:
         """
-        self._object_keeper[id(obj)] = obj
+        All rules, rules which only depend on attribute name and parent type, and the rest
+        """
+        if self._compiled is None:
+            self._compiled = (
+                _CompiledRules(self._exclude),
+                _CompiledRules([r for r in self._exclude if _is_static(r)]),
+                _CompiledRules([r for r in self._exclude if not _is_static(r)]),
+            )
+        return self._compiled
+
+    # TODO rename Context to Path?
+    def _get_attributes(self, obj: Any, path: Context, limits: Limits, stats: Optional[Stats]=None) -> List[Tuple[AttrName, Any]]:
+        if stats is not None:
+            return self._get_attributes_profiled(obj, path, limits, stats)
+        # TODO shit. inspect may result in exception even though we weren't intending to looking at the value :(
+        _, static, dynamic = self._rules()
+        tp = type(obj)
+
+        excluded_names = _per_type(self._static_excluded, tp)
 
-    def _make_elem(self, obj: Any, name: str) -> ET.Element:
+        def static_excluded(name: AttrName) -> bool:
+            if limits.prunes(name, leaf=False):
+                return True
+            res = excluded_names.get(name, None)
+            if res is None:
+                path.append((name, myinspect._inprogress))
+                res = static.matches(path)
+                path.pop()
+                excluded_names[name] = res
+            return res
+
+        static_key = static.key # type: Any
+        if static_key is not None and limits.prune_members and limits.names is not None:
+            static_key = (static_key, frozenset(limits.names))
+        return myinspect.getmembers(
+            obj,
+            path=path,
+            excluded=dynamic.matches,
+            static_excluded=static_excluded,
+            static_key=static_key,
+            cache=self._value_getter(obj, path),
+            fields=self.fields_only,
+            properties=self.field_properties,
+        )
+
+    def _make_elem(self, obj: Any, name: str, conv: _Conversion) -> ET.Element:
         res = ET.Element(name)
-        self._keep(obj)
-        res.set(self.python_id_attr, str(id(obj)))
+        conv.elements[res] = obj
+        conv.nodes += 1
+        if conv.stats is not None:
+            conv.stats.elements += 1
+        if self.python_id_attr is not None:
+            res.set(self.python_id_attr, str(id(obj)))
         return res
 
     def _as_xmlstr(self, obj) -> str:
         return ET.tostring(self.as_xml(obj), pretty_print=True, encoding='unicode')
 
-    def _is_excluded(self, ctx: Context) -> bool:
-        for ll in self._exclude:
-            if all([l(ctx) for l in ll]):
+    def _get_attributes_profiled(self, obj: Any, path: Context, limits: Limits, stats: Stats) -> List[Tuple[AttrName, Any]]:
+        """
+        Same as _get_attributes, but records time and exclusion rule hits.
+        Results of static rules aren't cached in the class layout, so hits are counted for each object
+        """
+        _, static, dynamic = self._rules()
+        tp = type(obj)
+        tname = self.type_name_map.get_type_name(obj)
+
+        excluded_names = _per_type(self._static_excluded, tp)
+
+        def static_excluded(name: AttrName) -> bool:
+            if limits.prunes(name, leaf=False):
                 return True
-        return False
+            res = excluded_names.get(name, None)
+            if res is None:
+                path.append((name, myinspect._inprogress))
+                res = static.matches(path)
+                path.pop()
+                excluded_names[name] = res
+            if res:
+                path.append((name, myinspect._inprogress))
+                self._record_hit(path, stats)
+                path.pop()
+            return res
+
+        def excluded(ctx: Context) -> bool:
+            start = perf_counter()
+            res = dynamic.matches(ctx)
+            stats._add('exclusion', perf_counter() - start)
+            if res:
+                self._record_hit(ctx, stats)
+            return res
+
+        def timer(name: AttrName, seconds: float) -> None:
+            stats._getattr(tname, name, seconds)
+            stats._add('getattr', seconds)
+
+        start = perf_counter()
+        res = myinspect.getmembers(
+            obj,
+            path=path,
+            excluded=excluded,
+            static_excluded=static_excluded,
+            timer=timer,
+            cache=self._value_getter(obj, path),
+            fields=self.fields_only,
+            properties=self.field_properties,
+        )
+        stats._add('members', perf_counter() - start)
+        stats.attributes += len(res)
+        return res
+
+    def _record_hit(self, ctx: Context, stats: Stats) -> None:
+        stats.excluded += 1
+        for rule in self._exclude:
+            if all(c(ctx) for c in rule):
+                key = _describe(rule)
+                stats.rule_hits[key] = stats.rule_hits.get(key, 0) + 1
+                return
 
-    def _as_xml(self, ctx: Context) -> Optional[ET.Element]:
-        if self._is_excluded(ctx):
+    def _is_excluded(self, ctx: Context) -> bool:
+        return self._rules()[0].matches(ctx)
+
+    def _check_excluded(self, ctx: Context, conv: _Conversion) -> bool:
+        stats = conv.stats
+        if stats is None:
+            return self._is_excluded(ctx)
+        start = perf_counter()
+        res = self._is_excluded(ctx)
+        stats._add('exclusion', perf_counter() - start)
+        if res:
+            self._record_hit(ctx, stats)
+        return res
+
+    def _make_ref(self, obj: Any, name: str, conv: _Conversion) -> Optional[ET.Element]:
+        """
+        Returns reference element if the object shouldn't be converted again
+        """
+        if self.dedup is None:
             return None
-        name, obj = ctx[-1]
+        oid = id(obj)
+        if oid in conv.on_path or (self.dedup == 'shared' and oid in conv.converted):
+            res = self._make_elem(obj, name, conv)
+            res.set(self.ref_attr, str(oid))
+            return res
+        return None
+
+    def _typed_dispatch(self) -> bool:
+        """
+        Whether kind of the objects only depends on their type, which is the case with default factories
+        """
+        return type(self.list_factory) is DefaultListFactory \
+            and type(self.primitive_factory) is DefaultPrimitiveFactory \
+            and type(self.dict_factory) is DefaultDictFactory \
+            and type(self.type_name_map) is TypeNameMap
+
+    def _plan(self, tp: Type[Any]) -> Plan:
+        """
+        Same decisions default factories make, but for the type
+        """
+        if self.fields_only and myinspect.is_namedtuple(tp):
+            return ('object', None, self.type_name_map.maps.get(tp, None) or tp.__name__)
+        if issubclass(tp, (list, set, tuple)):
+            return ('list', None, 'listish')
+        converter = self.primitive_factory.converters.get(tp, None)
+        if converter is not None:
+            return ('primitive', converter, 'primitivish')
+        tname = self.type_name_map.maps.get(tp, None) or tp.__name__
+        if issubclass(tp, dict):
+            return ('dict', None, tname)
+        return ('object', None, tname)
+
+    def _kind(self, obj: Any, plans: Optional[Dict[Type[Any], Plan]]=None) -> Kind:
+        """
+        Decides how the object is going to be converted: 'list', 'primitive' (along with the text), 'dict' (along with the dict)
+        or just 'object', and the tag of the resulting element
+
+        plans: cache of per type decisions, if they only depend on the type
+        """
+        if plans is not None:
+            tp = type(obj)
+            plan = plans.get(tp, None)
+            if plan is None:
+                plan = self._plan(tp)
+                plans[tp] = plan
+            what, converter, tag = plan
+            if converter is not None:
+                return (what, converter(obj), tag)
+            return (what, obj if what == 'dict' else None, tag)
+
+        if self.fields_only and myinspect.is_namedtuple(type(obj)):
+            return ('object', None, self.type_name_map.get_type_name(obj))
 
         ll = self.list_factory.as_list(obj)
         if ll is not None:
-            res = self._make_elem(obj, 'listish')
-            for x in obj:
-                ctx.append((None, x))
-                rr = self._as_xml(ctx)
-                ctx.pop()
-                if rr is not None:
-                    res.append(rr)
-            return res
+            return ('list', ll, 'listish')
 
         prim = self.primitive_factory.as_primitive(obj)
         if prim is not None:
-            el = self._make_elem(obj, 'primitivish')
-            el.text = prim
-            return el
+            return ('primitive', prim, 'primitivish')
 
         # everything else will be kinda like dictionary now
-
+        tname = self.type_name_map.get_type_name(obj)
         dd = self.dict_factory.as_dict(obj)
         if dd is not None:
-            attrs = list(dd.items())
+            return ('dict', dd, tname)
+        return ('object', None, tname)
+
+    def _accepts(self, ctx: Context, conv: _Conversion, checked: bool) -> Optional[Kind]:
+        """
+        Returns None if the object at the end of the context is excluded/pruned, otherwise its kind
+
+        checked: exclusion rules were already checked against this context
+        """
+        if not checked and self._check_excluded(ctx, conv):
+            return None
+        name, obj = ctx[-1]
+        kind = self._kind(obj, conv.plans)
+        # root is never pruned
+        if len(ctx) > 1 and conv.limits.prunes(name or kind[2], leaf=kind[0] == 'primitive'):
+            return None
+        return kind
+
+    def _children(self, ctx: Context, kind: Kind, conv: _Conversion) -> Iterator[Child]:
+        """
+        Children of the object at the end of the context, as (attribute name, value, checked) tuples
+        """
+        what, payload, _ = kind
+        obj = ctx[-1][1]
+        if what == 'list':
+            return ((None, x, False) for x in obj)
+        limits = conv.limits
+        if what == 'dict':
+            return ((k, v, False) for k, v in payload.items() if not limits.prunes(k, leaf=False))
+        # getmembers already filters out excluded members
+        attrs = self._get_attributes(obj, ctx, limits, stats=conv.stats)
+        return ((k, v, not isinstance(v, myinspect.InspectError)) for k, v in attrs)
+
+    def _visit(self, ctx: Context, conv: _Conversion, checked: bool) -> Tuple[Optional[ET.Element], Optional[Iterator[Child]]]:
+        """
+        Converts the object at the end of the context into element, without its children.
+        Returns None instead of the element if the object was excluded/pruned,
+        and children (if element needs to be expanded)
+        """
+        kind = self._accepts(ctx, conv, checked)
+        if kind is None:
+            return None, None
+        what, payload, tag = kind
+        obj = ctx[-1][1]
+
+        if what == 'primitive':
+            el = self._make_elem(obj, tag, conv)
+            el.text = payload
+            return el, None
+
+        ref = self._make_ref(obj, tag, conv)
+        if ref is not None:
+            return ref, None
+        if self.compact_sequences is not None:
+            items = self._compact_items(obj, kind)
+            summary = None if items is None else self._compact_summary(items, conv)
+            if summary is not None:
+                res = self._make_elem(obj, tag, conv)
+                for k, v in summary.items():
+                    res.set(k, v)
+                conv.compact[res] = (items, self)
+                _compact_conversions.add(conv)
+                return res, None
+        res = self._make_elem(obj, tag, conv)
+        if not conv.limits.expands(len(ctx)):
+            return res, None
+        budget = conv.budget
+        if budget is None:
+            self._enter(obj, conv)
+            return res, self._children(ctx, kind, conv)
+
+        size = len(obj if payload is None else payload) if what in {'list', 'dict'} else None
+        if budget.max_depth is not None and len(ctx) >= budget.max_depth:
+            # no way to tell if an object has any attributes without inspecting it
+            if size is None or size > 0:
+                self._truncate(res, 'depth', conv)
+            return res, None
+        self._enter(obj, conv)
+        children = self._children(ctx, kind, conv)
+        if budget.max_items is not None and size is not None and size > budget.max_items:
+            self._truncate(res, 'items', conv)
+            children = islice(children, budget.max_items)
+        return res, children
+
+    def _truncate(self, el: ET.Element, reason: str, conv: _Conversion) -> None:
+        assert conv.budget is not None
+        if not conv.budget.partial:
+            raise HiccupError('conversion exceeded the budget: {}'.format(reason))
+        el.set(self.truncated_attr, reason)
+        conv.truncated = True
+
+    @staticmethod
+    def _compact_items(obj: Any, kind: Kind) -> Optional[Any]:
+        """
+        Items of the object if it's a sequence which could be compacted
+        """
+        what, payload, _ = kind
+        if what == 'list':
+            items = obj if payload is None else payload
+        elif isinstance(obj, array.array):
+            items = obj
         else:
-            attrs = self._get_attributes(obj, ctx)
+            return None
+        if not isinstance(items, (list, tuple, array.array)):
+            items = list(items)
+        return items
+
+    def _compact_summary(self, items: Any, conv: _Conversion) -> Optional[Dict[str, str]]:
+        """
+        None if the items shouldn't be compacted: too few of them, or not all of the same primitive type
+        """
+        threshold = self.compact_sequences
+        if threshold is None or len(items) < max(threshold, 1):
+            return None
+        first = items[0]
+        tp = type(first)
+        for x in items:
+            if type(x) is not tp:
+                return None
+        what, text, _ = self._kind(first, conv.plans)
+        if what != 'primitive':
+            return None
+        res = {
+            'length': str(len(items)),
+            'itemtype': self.type_name_map.get_type_name(first),
+        }
+        if issubclass(tp, (int, float)):
+            res['min'] = self._kind(min(items), conv.plans)[1]
+            res['max'] = self._kind(max(items), conv.plans)[1]
+        return res
+
+    def _as_xml(self, ctx: Context, conv: _Conversion) -> Optional[ET.Element]:
+        """
+        Uses explicit stack instead of recursion, so deep objects don't hit recursion limit
+        """
+        root, children = self._visit(ctx, conv, checked=False)
+        if children is None:
+            return root
+        # element, corresponding object and its remaining children
+        stack = [(root, ctx[-1][1], children)] # type: List[Tuple[ET.Element, Any, Iterator[Child]]]
+        while len(stack) > 0:
+            if conv.budget is not None:
+                reason = conv.exceeded()
+                if reason is not None:
+                    self._stop(stack, ctx, reason, conv)
+                    break
+            parent, pobj, pchildren = stack[-1]
+            child = next(pchildren, None)
+            if child is None:
+                stack.pop()
+                self._exit(pobj, conv)
+                ctx.pop()
+                continue
 
-        res = self._make_elem(obj, self.type_name_map.get_type_name(obj))
-        for k, v in attrs:
+            k, v, checked = child
             ctx.append((k, v))
-            oo = self._as_xml(ctx)
+            el, children = self._visit(ctx, conv, checked=checked)
+            if el is not None and k is not None:
+                el = self._retag(el, k)
+            if el is not None:
+                parent.append(el)
+            if el is not None and children is not None:
+                stack.append((el, v, children))
+            else:
+                if children is not None:
+                    self._exit(v, conv)
+                ctx.pop()
+        return root
+
+    def _stop(self, stack: List[Tuple[ET.Element, Any, Iterator[Child]]], ctx: Context, reason: str, conv: _Conversion) -> None:
+        """
+        Abandons conversion, marking the elements which still had children to convert
+        """
+        while len(stack) > 0:
+            el, obj, children = stack.pop()
+            if next(children, None) is not None:
+                self._truncate(el, reason, conv)
+            self._exit(obj, conv)
             ctx.pop()
-            if oo is not None:
-                try:
-                    oo.tag = k
-                    ## TODO class attribute??
-                    res.append(oo)
-                except ValueError as e:
-                    if 'Invalid tag name' in str(e):
-                        # TODO log??
-                        pass
-                    else:
-                        raise e
-        return res
 
-    def as_xml(self, obj: Any) -> Optional[ET.Element]:
-        return self._as_xml([(None, obj)])
+    @staticmethod
+    def _retag(el: ET.Element, name: AttrName) -> Optional[ET.Element]:
+        try:
+            el.tag = name
+            ## TODO class attribute??
+        except ValueError as e:
+            if 'Invalid tag name' in str(e):
+                # TODO log??
+                return None
+            raise e
+        return el
+
+    def _enter(self, obj: Any, conv: _Conversion) -> None:
+        oid = id(obj)
+        # conversion doesn't recurse, so without this check a cycle would go on until we run out of memory
+        if oid in conv.on_path:
+            raise HiccupError('reference cycle through {} object, exclude it or set dedup'.format(type(obj).__name__))
+        conv.on_path.add(oid)
+
+    def _exit(self, obj: Any, conv: _Conversion) -> None:
+        conv.on_path.discard(id(obj))
+        if self.dedup is not None:
+            conv.converted.add(id(obj))
+
+    def _convert(self, obj: Any, limits: Optional[Limits], stats: Optional[Stats]=None) -> Tuple[Optional[ET.Element], _Conversion]:
+        if self.dedup not in {None, 'cycles', 'shared'}:
+            raise HiccupError('unexpected dedup policy: {}'.format(self.dedup))
+        conv = _Conversion(limits=Limits() if limits is None else limits, stats=stats, plans={} if self._typed_dispatch() else None)
+        conv.start(self.budget)
+        start = perf_counter()
+        xml = self._as_xml([(None, obj)], conv)
+        if stats is not None:
+            stats._add('convert', perf_counter() - start)
+        return xml, conv
+
+    def as_xml(self, obj: Any, limits: Optional[Limits]=None) -> Optional[ET.Element]:
+        """
+        Note that objects aren't kept alive after conversion, use snapshot() if you want to map elements back to objects
+        """
+        return self._convert(obj, limits=limits)[0]
+
+    def compile(self, query: Xpath) -> ET.XPath:
+        namespaces = self.xpath_namespaces # type: Any
+        extensions = self.xpath_extensions # type: Any
+        if self.compact_sequences is not None:
+            namespaces = dict(namespaces or {})
+            namespaces.setdefault('hiccup', HICCUP_NS)
+            extensions = _COMPACT_EXTENSIONS if extensions is None else [extensions, _COMPACT_EXTENSIONS]
+        return self.xpath_cache.get(query, namespaces=namespaces, extensions=extensions)
+
+    def prewarm(self, queries: Iterable[Xpath]) -> None:
+        """
+        Compiles queries known in advance (e.g. at startup) into xpath_cache, with the same namespaces and extensions queries use
+        """
+        for q in queries:
+            self.compile(q)
+
+    def _limits(self, queries: Optional[Iterable[Xpath]]) -> Limits:
+        if queries is None or not (self.lazy or self.prune):
+            return Limits()
+        analysis = None # type: Optional[QueryAnalysis]
+        for q in queries:
+            qa = analyze(q)
+            analysis = qa if analysis is None else analysis.merge(qa)
+        if analysis is None:
+            return Limits()
+        return Limits(
+            max_depth=analysis.max_depth if self.lazy else None,
+            names=analysis.names if self.prune else None,
+            # without descendant axes, all elements relevant to the query have to be mentioned in it explicitly
+            prune_members=self.prune and analysis.max_depth is not None,
+        )
+
+    def snapshot(self, obj: Any, queries: Optional[Iterable[Xpath]]=None, profile: Optional[bool]=None) -> 'Snapshot':
+        """
+        Converts the object once, so it can be queried multiple times.
+        The snapshot reflects the state of the object at the moment of the call.
 
-    def xquery(self, obj: Any, query: Xpath) -> List[Result]:
-        xml = self.as_xml(obj)
+        In lazy/prune mode, you can pass the queries you're going to run, so only the parts they can reach are converted.
+        profile: collect Stats, overrides Hiccup.profile
+        """
+        limits = self._limits(queries)
+        stats = Stats() if (self.profile if profile is None else profile) else None
+        xml, conv = self._convert(obj, limits=limits, stats=stats)
         assert xml is not None
 
         if self.xml_hook is not None:
+            start = perf_counter()
             # pylint: disable=not-callable
             self.xml_hook(xml)
+            if stats is not None:
+                stats._add('hook', perf_counter() - start)
 
-        xelems = xml.xpath(query)
-        py_ids = [int(x.attrib[self.python_id_attr]) for x in xelems]
-        return [di(py_id) for py_id in py_ids]
+        snap = Snapshot(hiccup=self, xml=xml, conv=conv)
+        self._snapshots.add(snap)
+        return snap
+
+    def keeper_size(self) -> int:
+        """
+        Number of elements (and objects they refer to) kept alive by snapshots which are still open
+        """
+        return sum(s.keeper_size() for s in list(self._snapshots))
+
+    def xquery_iter(self, obj: Any, query: Xpath, limit: Optional[int]=None) -> Iterator[Result]:
+        with self.snapshot(obj, queries=[query]) as snap:
+            yield from snap.xquery_iter(query, limit=limit)
+
+    def xquery(self, obj: Any, query: Xpath, limit: Optional[int]=None) -> List[Result]:
+        with self.snapshot(obj, queries=[query]) as snap:
+            return snap.xquery(query, limit=limit)
+
+    def xquery_stats(self, obj: Any, query: Xpath, limit: Optional[int]=None) -> Tuple[List[Result], Stats]:
+        """
+        Same as xquery, but also returns profiling information, regardless of Hiccup.profile
+        """
+        with self.snapshot(obj, queries=[query], profile=True) as snap:
+            stats = snap.stats
+            assert stats is not None
+            return snap.xquery(query, limit=limit), stats
+
+    def xquery_many(self, obj: Any, queries: Dict[str, Xpath]) -> Dict[str, List[Result]]:
+        with self.snapshot(obj, queries=queries.values()) as snap:
+            return snap.xquery_many(queries)
 
     def xquery_single(self, obj: Any, query: Xpath) -> Result:
-       res = self.xquery(obj, query)
-       if len(res) != 1:
-           raise HiccupError('{}: expected single result, got {} instead'.format(query, res))
-       return res[0]
+        with self.snapshot(obj, queries=[query]) as snap:
+            return snap.xquery_single(query)
 
     def xfind_all(self, *args, **kwargs):
         return self.xquery(*args, **kwargs)
@@ -288,12 +1381,579 @@ class Hiccup:
     def xfind(self, *args, **kwargs):
         return self.xquery_single(*args, **kwargs)
 
+
+_DESCENDANT_TAG = re.compile(r'\s*//([^\W\d][\w.\-]*)\s*')
+_MISSING = object()
+_LITERAL = r'''(?:"[^"]*"|'[^']*')'''
+_INDEXED = re.compile(r'''\s*//(?P<tag>[^\W\d][\w.\-]*|\*)(?:\[\s*(?:
+    text\(\)\s*=\s*(?P<eq>{lit})
+  | starts-with\(\s*text\(\)\s*,\s*(?P<prefix>{lit})\s*\)
+)\s*\])?\s*'''.format(lit=_LITERAL), re.VERBOSE)
+
+
+class _ValueIndex:
+    """
+    Elements by name and by text, in document order. Elements are referred to by their position in document order
+    """
+    def __init__(self, xml: ET.Element) -> None:
+        self.tags = {} # type: Dict[str, List[int]]
+        # texts regardless of the element name are indexed under None, on first use
+        self.texts = {} # type: Dict[Optional[str], Dict[str, List[int]]]
+        self._sorted = {} # type: Dict[str, List[str]]
+        self.elements = list(xml.iter())
+        tags = self.tags
+        texts = self.texts
+        for i, el in enumerate(self.elements):
+            tag = el.tag
+            ids = tags.get(tag, None)
+            if ids is None:
+                ids = tags[tag] = []
+                texts[tag] = {}
+            ids.append(i)
+            text = el.text
+            if text is not None:
+                by_text = texts[tag]
+                ids = by_text.get(text, None)
+                if ids is None:
+                    by_text[text] = [i]
+                else:
+                    ids.append(i)
+
+    def _texts(self, tag: str) -> Dict[str, List[int]]:
+        key = None if tag == '*' else tag
+        res = self.texts.get(key, None)
+        if res is None:
+            if key is not None:
+                return {}
+            res = {}
+            for by_text in list(self.texts.values()):
+                for text, ids in by_text.items():
+                    res.setdefault(text, []).extend(ids)
+            for ids in res.values():
+                ids.sort()
+            self.texts[None] = res
+        return res
+
+    def named(self, tag: str) -> List[ET.Element]:
+        if tag == '*':
+            return list(self.elements)
+        return [self.elements[i] for i in self.tags.get(tag, [])]
+
+    def equal(self, tag: str, text: str) -> List[ET.Element]:
+        return [self.elements[i] for i in self._texts(tag).get(text, [])]
+
+    def starting_with(self, tag: str, prefix: str) -> List[ET.Element]:
+        texts = self._texts(tag)
+        keys = self._sorted.get(tag, None)
+        if keys is None:
+            keys = sorted(texts)
+            self._sorted[tag] = keys
+        found = [] # type: List[int]
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            found.extend(texts[keys[i]])
+        found.sort()
+        return [self.elements[i] for i in found]
+
+
+_valid_tags = {} # type: Dict[Any, bool]
+
+
+def _valid_tag(name: Any) -> bool:
+    res = _valid_tags.get(name, None)
+    if res is None:
+        try:
+            ET.Element(name)
+            res = True
+        except (ValueError, TypeError):
+            res = False
+        if len(_valid_tags) < 10000:
+            _valid_tags[name] = res
+    return res
+
+
+# attributes of compacted sequences
+_SUMMARY_KEYS = ('length', 'itemtype', 'min', 'max')
+
+
+class Snapshot:
+    """
+    Converted xml along with the objects its elements refer to.
+    Objects are kept alive until the snapshot is closed (or garbage collected), you can use it as a context manager.
+    """
+    def __init__(self, hiccup: Hiccup, xml: ET.Element, conv: _Conversion) -> None:
+        self.hiccup = hiccup
+        self.xml = xml
+        self._conv = conv
+        self._objects = conv.elements
+        self.limits = conv.limits
+        self.stats = conv.stats
+        self.closed = False
+        self._dirty = {} # type: Dict[int, Any]
+        self._by_id = None # type: Optional[Dict[int, List[ET.Element]]]
+        self._subscriptions = [] # type: List[Subscription]
+        self._modified = False
+        self._value_index = None # type: Optional[_ValueIndex]
+
+    def close(self) -> None:
+        if not self.closed and self.stats is not None and self.hiccup.stats_hook is not None:
+            # pylint: disable=not-callable
+            self.hiccup.stats_hook(self.stats)
+        self.closed = True
+        self._objects = {}
+        self._conv = _Conversion(limits=self.limits)
+        self._dirty = {}
+        self._by_id = None
+        self._subscriptions = []
+        self._value_index = None
+        self.xml = None
+
+    @property
+    def truncated(self) -> bool:
+        """
+        Whether conversion ran out of Hiccup.budget, so query results might be partial
+        """
+        return self._conv.truncated
+
+    def __enter__(self) -> 'Snapshot':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def keeper_size(self) -> int:
+        return len(self._objects)
+
+    def mark_dirty(self, obj: Any) -> None:
+        """
+        Marks the object as modified, so its elements get rebuilt on the next refresh()
+        """
+        self._dirty[id(obj)] = obj
+
+    def refresh(self, detect: bool=False) -> int:
+        """
+        Brings the snapshot up to date with the objects, only rebuilding the elements that changed.
+        Elements of the objects passed to mark_dirty() are always rebuilt.
+
+        detect: also look for changes by checking identity of attributes, list items and dict values, and values of primitives.
+                Cheaper than converting from scratch, but still has to visit every object in the snapshot.
+        Note that xml_hook isn't applied to the rebuilt elements.
+        With dedup='shared', any change rebuilds the whole snapshot.
+
+        Returns the number of rebuilt elements.
+        """
+        if self.closed:
+            raise HiccupError('snapshot is closed')
+        # elements along with their up to date objects
+        changed = [] # type: List[Tuple[ET.Element, Any]]
+        if len(self._dirty) > 0:
+            by_id = self._index_by_id()
+            for oid, obj in self._dirty.items():
+                changed.extend((el, obj) for el in by_id.get(oid, []))
+            self._dirty = {}
+        if detect:
+            changed.extend(self._detect())
+        if self.hiccup.dedup == 'shared' and len(changed) > 0:
+            # elements elsewhere may be references to objects converted within the changed elements, so rebuild everything
+            root = [obj for el, obj in changed if el is self.xml]
+            changed = [(self.xml, root[-1] if len(root) > 0 else self._objects[self.xml])]
+
+        # outermost first, so we don't bother rebuilding elements which are replaced along with their ancestors anyway
+        changed.sort(key=lambda c: sum(1 for _ in c[0].iterancestors()))
+        rebuilt = 0
+        for el, obj in changed:
+            if el not in self._objects:
+                continue
+            self._rebuild(el, obj)
+            rebuilt += 1
+
+        modified = self._modified
+        self._modified = False
+        if modified:
+            self._value_index = None
+        for sub in list(self._subscriptions):
+            sub._update(modified)
+        return rebuilt
+
+    def subscribe(self, query: Xpath, callback: Optional[Callable[['Subscription'], None]]=None) -> 'Subscription':
+        """
+        Registers a standing query: after each refresh(), the subscription holds the objects added to and removed from its results.
+        callback: called with the subscription after refreshes which changed the results
+        """
+        if self.closed:
+            raise HiccupError('snapshot is closed')
+        self._check_limits(query)
+        sub = Subscription(self, query, callback=callback)
+        self._subscriptions.append(sub)
+        return sub
+
+    def _fast_subscriptions(self) -> List['Subscription']:
+        return [s for s in self._subscriptions if s.tag is not None]
+
+    def _index_by_id(self) -> Dict[int, List[ET.Element]]:
+        if self._by_id is None:
+            by_id = {} # type: Dict[int, List[ET.Element]]
+            for el, obj in self._objects.items():
+                by_id.setdefault(id(obj), []).append(el)
+            self._by_id = by_id
+        return self._by_id
+
+    def _set_object(self, el: ET.Element, obj: Any) -> None:
+        self._modified = True
+        for sub in self._fast_subscriptions():
+            if el.tag == sub.tag:
+                sub._touch(self._objects[el], -1)
+                sub._touch(obj, 1)
+        if self._by_id is not None:
+            self._unindex(el, self._objects[el])
+            self._by_id.setdefault(id(obj), []).append(el)
+        self._objects[el] = obj
+
+    def _unindex(self, el: ET.Element, obj: Any) -> None:
+        assert self._by_id is not None
+        els = self._by_id[id(obj)]
+        els.remove(el)
+        if len(els) == 0:
+            del self._by_id[id(obj)]
+
+    def _forget(self, root: ET.Element) -> None:
+        """
+        Drops the objects of the element and all of its descendants
+        """
+        conv = self._conv
+        ref_attr = self.hiccup.ref_attr
+        for el in root.iter():
+            obj = self._objects.pop(el, _MISSING)
+            if obj is _MISSING:
+                continue
+            conv.compact.pop(el, None)
+            conv.nodes -= 1
+            if el.get(ref_attr) is None:
+                conv.converted.discard(id(obj))
+            if self._by_id is not None:
+                self._unindex(el, obj)
+
+    def _context(self, el: ET.Element) -> Context:
+        chain = [el] + list(el.iterancestors())
+        chain.reverse()
+        ctx = [] # type: Context
+        parent_is_list = False
+        for i, x in enumerate(chain):
+            obj = self._objects[x]
+            ctx.append((None if i == 0 or parent_is_list else x.tag, obj))
+            parent_is_list = self.hiccup._kind(obj, self._conv.plans)[0] == 'list'
+        return ctx
+
+    def _rebuild(self, el: ET.Element, obj: Any) -> None:
+        h = self.hiccup
+        conv = self._conv
+        ctx = self._context(el)
+        name = ctx[-1][0]
+        ctx[-1] = (name, obj)
+        self._modified = True
+        subs = self._fast_subscriptions()
+        for sub in subs:
+            for x in el.iter(sub.tag):
+                sub._touch(self._objects[x], -1)
+        self._forget(el)
+
+        conv.on_path = {id(o) for _, o in ctx[:-1]}
+        conv.start(h.budget)
+        new = h._as_xml(ctx, conv)
+        conv.on_path = set()
+        if new is not None and name is not None:
+            new = h._retag(new, name)
+
+        if new is not None and self._by_id is not None:
+            for x in new.iter():
+                self._by_id.setdefault(id(self._objects[x]), []).append(x)
+        if new is not None:
+            for sub in subs:
+                for x in new.iter(sub.tag):
+                    sub._touch(self._objects[x], 1)
+
+        parent = el.getparent()
+        if parent is None:
+            if new is None:
+                raise HiccupError('root object is excluded')
+            self.xml = new
+        elif new is None:
+            parent.remove(el)
+        else:
+            parent.replace(el, new)
+
+    def _detect(self) -> List[Tuple[ET.Element, Any]]:
+        """
+        Returns the elements which have to be rebuilt, along with their new objects
+        """
+        h = self.hiccup
+        conv = self._conv
+        res = [] # type: List[Tuple[ET.Element, Any]]
+        ctx = [] # type: Context
+        # element, its attribute name and depth
+        stack = [(self.xml, None, 1)] # type: List[Tuple[ET.Element, Optional[AttrName], int]]
+        while len(stack) > 0:
+            el, name, depth = stack.pop()
+            obj = self._objects[el]
+            del ctx[depth - 1:]
+            ctx.append((name, obj))
+            if h.dedup is not None and el.get(h.ref_attr) is not None:
+                continue
+            if conv.budget is not None and el.get(h.truncated_attr) is not None:
+                # can't tell what changed in the parts which weren't converted
+                continue
+            kind = h._kind(obj, conv.plans)
+            if kind[0] == 'primitive':
+                if (el.text or '') != kind[1]:
+                    res.append((el, obj))
+                continue
+            if el in conv.compact:
+                # items are looked up on demand, so only the summary has to be up to date
+                items = h._compact_items(obj, kind)
+                summary = None if items is None else h._compact_summary(items, conv)
+                if summary is None or summary != {k: el.get(k) for k in _SUMMARY_KEYS if el.get(k) is not None}:
+                    res.append((el, obj))
+                else:
+                    conv.compact[el] = (items, h)
+                continue
+            if not conv.limits.expands(depth):
+                continue
+
+            kids = list(el)
+            i = 0
+            unchanged = [] # type: List[Tuple[ET.Element, Optional[AttrName]]]
+            mismatch = False
+            for k, v, checked in h._children(ctx, kind, conv):
+                ctx.append((k, v))
+                ckind = h._accepts(ctx, conv, checked)
+                ctx.pop()
+                if ckind is None or (k is not None and not _valid_tag(k)):
+                    continue
+                if i >= len(kids) or kids[i].tag != (ckind[2] if k is None else k):
+                    mismatch = True
+                    break
+                kid = kids[i]
+                i += 1
+                if self._objects[kid] is v:
+                    unchanged.append((kid, k))
+                elif ckind[0] == 'primitive' and (kid.text or '') == ckind[1] and len(kid) == 0:
+                    # equal primitive, no need to rebuild
+                    self._set_object(kid, v)
+                else:
+                    res.append((kid, v))
+            if mismatch or i != len(kids):
+                # attributes or items were added/removed
+                res.append((el, obj))
+                continue
+            for kid, k in reversed(unchanged):
+                stack.append((kid, k, depth + 1))
+        return res
+
+    def _as_object(self, xelem: ET.Element) -> Result:
+        try:
+            return self._objects[xelem]
+        except (KeyError, TypeError):
+            raise HiccupError('{} does not correspond to any object'.format(xelem))
+
+    def _check_limits(self, query: Xpath) -> None:
+        if not self.limits.covers(analyze(query)):
+            raise HiccupError('{}: snapshot was only partially converted, query might give wrong results'.format(query))
+
+    def xquery_iter(self, query: Xpath, limit: Optional[int]=None) -> Iterator[Result]:
+        """
+        Maps results to objects as they are consumed.
+        limit: return at most that many results (in document order). Lets lxml avoid creating the rest of the result elements
+        """
+        if self.closed:
+            raise HiccupError('{}: snapshot is closed'.format(query))
+        self._check_limits(query)
+        stats = self.stats
+        if stats is not None:
+            stats.queries += 1
+        start = perf_counter()
+        xelems = None
+        if self.hiccup.value_index:
+            found = self._indexed(query)
+            if found is not None:
+                xelems = found if limit is None else found[:max(int(limit), 0)]
+        if xelems is None:
+            if limit is not None:
+                query = '({})[position() <= {}]'.format(query, int(limit))
+            xelems = self.hiccup.compile(query)(self.xml)
+        if stats is None:
+            return (self._as_object(x) for x in xelems)
+        stats._add('xpath', perf_counter() - start)
+        return self._as_objects_profiled(xelems, stats)
+
+    def _as_objects_profiled(self, xelems: Iterable[ET.Element], stats: Stats) -> Iterator[Result]:
+        for x in xelems:
+            start = perf_counter()
+            res = self._as_object(x)
+            stats._add('map', perf_counter() - start)
+            yield res
+
+    def _indexed(self, query: Xpath) -> Optional[List[ET.Element]]:
+        """
+        Returns None if the query can't be answered from the value index
+        """
+        m = _INDEXED.fullmatch(query)
+        if m is None:
+            return None
+        if self._value_index is None:
+            self._value_index = _ValueIndex(self.xml)
+        tag = m.group('tag')
+        eq = m.group('eq')
+        prefix = m.group('prefix')
+        if eq is not None:
+            return self._value_index.equal(tag, eq[1:-1])
+        if prefix is not None:
+            return self._value_index.starting_with(tag, prefix[1:-1])
+        return self._value_index.named(tag)
+
+    def xquery(self, query: Xpath, limit: Optional[int]=None) -> List[Result]:
+        return list(self.xquery_iter(query, limit=limit))
+
+    def locate(self, query: Xpath) -> List[str]:
+        """
+        Returns xpaths of the result elements, which can be used to find the results again in another conversion of the same object
+        """
+        if self.closed:
+            raise HiccupError('{}: snapshot is closed'.format(query))
+        self._check_limits(query)
+        tree = self.xml.getroottree()
+        res = [] # type: List[str]
+        for x in self.hiccup.compile(query)(self.xml):
+            if not isinstance(x, ET._Element):
+                raise HiccupError('{} does not correspond to any object'.format(x))
+            res.append(tree.getpath(x))
+        return res
+
+    def xquery_many(self, queries: Dict[str, Xpath]) -> Dict[str, List[Result]]:
+        """
+        Runs multiple queries against the snapshot. Queries of the form '//tag' are answered in a single pass over the xml.
+        """
+        res = {} # type: Dict[str, List[Result]]
+        by_tag = {} # type: Dict[str, List[str]]
+        for key, query in queries.items():
+            m = _DESCENDANT_TAG.fullmatch(query)
+            if m is None:
+                res[key] = self.xquery(query)
+            else:
+                by_tag.setdefault(m.group(1), []).append(key)
+
+        if len(by_tag) > 0:
+            if self.closed:
+                raise HiccupError('snapshot is closed')
+            for keys in by_tag.values():
+                for k in keys:
+                    self._check_limits(queries[k])
+                    res[k] = []
+            for x in self.xml.iter(*by_tag.keys()):
+                o = self._as_object(x)
+                for k in by_tag[x.tag]:
+                    res[k].append(o)
+        return {k: res[k] for k in queries}
+
+    def xquery_single(self, query: Xpath) -> Result:
+        # no need to look past the second result
+        res = self.xquery(query, limit=2)
+        if len(res) != 1:
+            raise HiccupError('{}: expected single result, got {} instead'.format(query, res))
+        return res[0]
+
+    def xfind_all(self, *args, **kwargs):
+        return self.xquery(*args, **kwargs)
+
+    def xfind(self, *args, **kwargs):
+        return self.xquery_single(*args, **kwargs)
+
+
+class Subscription:
+    """
+    Standing query against a snapshot, see Snapshot.subscribe.
+    After each refresh of the snapshot, 'added' and 'removed' hold the objects which appeared in/disappeared from the results.
+    Objects are compared by identity.
+
+    Queries of the form '//tag' are maintained incrementally, by only looking at the rebuilt elements.
+    Other queries are reevaluated whenever the refresh changed anything.
+    """
+    def __init__(self, snapshot: Snapshot, query: Xpath, callback: Optional[Callable[['Subscription'], None]]=None) -> None:
+        self.snapshot = snapshot
+        self.query = query
+        self.callback = callback
+        m = _DESCENDANT_TAG.fullmatch(query)
+        self.tag = None if m is None else m.group(1) # type: Optional[str]
+        self.added = [] # type: List[Result]
+        self.removed = [] # type: List[Result]
+        # number of results corresponding to the object, along with the object itself
+        self._counts = self._count(snapshot.xquery(query))
+        # counts at the beginning of the refresh, for the objects touched during it
+        self._before = OrderedDict() # type: OrderedDict[int, Tuple[Any, int]]
+
+    @staticmethod
+    def _count(results: List[Result]) -> Dict[int, Tuple[Any, int]]:
+        res = {} # type: Dict[int, Tuple[Any, int]]
+        for r in results:
+            res[id(r)] = (r, res.get(id(r), (r, 0))[1] + 1)
+        return res
+
+    def _touch(self, obj: Any, delta: int) -> None:
+        oid = id(obj)
+        cur = self._counts.get(oid, (obj, 0))[1]
+        if oid not in self._before:
+            self._before[oid] = (obj, cur)
+        if cur + delta == 0:
+            del self._counts[oid]
+        else:
+            self._counts[oid] = (obj, cur + delta)
+
+    def _update(self, modified: bool) -> None:
+        if self.tag is None and modified:
+            old = self._counts
+            self._counts = self._count(self.snapshot.xquery(self.query))
+            for oid, (o, _) in old.items():
+                self._before[oid] = (o, 1)
+            for oid, (o, _) in self._counts.items():
+                self._before.setdefault(oid, (o, 0))
+
+        self.added = []
+        self.removed = []
+        for oid, (o, before) in self._before.items():
+            now = oid in self._counts
+            if now and before == 0:
+                self.added.append(self._counts[oid][0])
+            elif not now and before > 0:
+                self.removed.append(o)
+        self._before = OrderedDict()
+        if self.callback is not None and (len(self.added) > 0 or len(self.removed) > 0):
+            # pylint: disable=not-callable
+            self.callback(self)
+
+    @property
+    def results(self) -> List[Result]:
+        return self.snapshot.xquery(self.query)
+
+    def close(self) -> None:
+        if self in self.snapshot._subscriptions:
+            self.snapshot._subscriptions.remove(self)
+
+
 def xquery(obj, query: Xpath, cls=Hiccup) -> List[Result]:
     return cls().xquery(obj=obj, query=query)
 
+
+def xquery_iter(obj, query: Xpath, cls=Hiccup) -> Iterator[Result]:
+    return cls().xquery_iter(obj=obj, query=query)
+
+
 def xquery_single(obj: Any, query: Xpath, cls=Hiccup) -> Result:
     return cls().xquery_single(obj=obj, query=query)
 
+
+def snapshot(obj: Any, cls=Hiccup) -> Snapshot:
+    return cls().snapshot(obj=obj)
+
+
 xfind = xquery_single
 xfind_all = xquery
-
@@ -0,0 +1,228 @@
+"""
+Running the same query against many independent root objects, spread across worker processes.
+"""
+import os
+import pickle
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple # noqa: F401 Dict is only used in type comments
+
+# pylint: disable=import-error
+from lxml import etree as ET
+
+from . import Hiccup, HiccupError, Xpath, Result
+from .query import analyze
+
+
+# stable reference to a query result: index of the root in the corpus and xpath of the result element within the root
+Locator = NamedTuple('Locator', [('root', int), ('path', str)])
+
+
+def resolve(locator: Locator, root: Any, hiccup: Optional[Hiccup]=None) -> Result:
+    """
+    Maps the locator back to the object, given the root it refers to
+    """
+    h = Hiccup() if hiccup is None else hiccup
+    return h.xquery_single(root, locator.path)
+
+
+class CorpusIndex:
+    """
+    Inverted index over a corpus of roots: element name -> roots containing such elements,
+    and (element name, text) -> roots containing such element with exactly that text.
+
+    Lets the query planner skip the roots which can't possibly match the query, without converting them.
+    Texts longer than max_text aren't indexed, queries which require them can't use the index.
+    The index is only valid for queries converting the roots with the same configuration (exclusions, factories, type names, xml_hook, etc.)
+    as hiccup, xquery_corpus checks that.
+    """
+    def __init__(self, hiccup: Optional[Hiccup]=None, max_text: int=256) -> None:
+        self.hiccup = Hiccup() if hiccup is None else hiccup
+        self.max_text = max_text
+        self.roots = set() # type: Set[int]
+        self.tags = {} # type: Dict[str, Set[int]]
+        self.texts = {} # type: Dict[Tuple[str, str], Set[int]]
+
+    def add(self, key: int, root: Any) -> None:
+        """
+        key: index of the root in the corpus
+        """
+        # queries see the xml after xml_hook, so should the index
+        with self.hiccup.snapshot(root) as snap:
+            self.add_xml(key, snap.xml)
+
+    def add_xml(self, key: int, xml: ET.Element) -> None:
+        self.roots.add(key)
+        max_text = self.max_text
+        for el in xml.iter():
+            tag = el.tag
+            self.tags.setdefault(tag, set()).add(key)
+            text = el.text
+            if text is not None and len(el) == 0 and len(text) <= max_text:
+                self.texts.setdefault((tag, text), set()).add(key)
+
+    def candidates(self, query: Xpath) -> Set[int]:
+        """
+        Indexed roots which might have results for the query
+        """
+        qa = analyze(query)
+        res = self.roots
+        for name in qa.required_names:
+            res = res & self.tags.get(name, set())
+        for name, text in qa.required_texts:
+            if len(text) <= self.max_text:
+                res = res & self.texts.get((name, text), set())
+        return res
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as fo:
+            pickle.dump(self, fo)
+
+    @staticmethod
+    def load(path: str) -> 'CorpusIndex':
+        with open(path, 'rb') as fo:
+            res = pickle.load(fo)
+        if not isinstance(res, CorpusIndex):
+            raise HiccupError('{}: not a corpus index'.format(path))
+        return res
+
+
+def _conversion_config(h: Hiccup) -> bytes:
+    """
+    Parts of the configuration which affect names and texts of the elements, i.e. what the index relies on
+    """
+    try:
+        return pickle.dumps((
+            h._exclude,
+            h.primitive_factory,
+            h.list_factory,
+            h.dict_factory,
+            h.type_name_map,
+            h.dedup,
+            h.fields_only,
+            h.field_properties,
+            h.compact_sequences,
+            h.budget,
+            h.xml_hook,
+        ))
+    except Exception as e:
+        raise HiccupError('Hiccup configuration has to be picklable: {}'.format(e)) from e
+
+
+def build_index(
+        roots: Iterable[Any],
+        hiccup: Optional[Hiccup]=None,
+        loader: Optional[Callable[[Any], Any]]=None,
+        max_text: int=256,
+) -> CorpusIndex:
+    index = CorpusIndex(hiccup=hiccup, max_text=max_text)
+    for i, root in enumerate(roots):
+        index.add(i, root if loader is None else loader(root))
+    return index
+
+
+Chunk = List[Tuple[int, Any]]
+ChunkResult = List[Tuple[int, List[Any]]]
+
+# configuration unpickled in the worker process, reused across chunks
+_worker_config = None # type: Optional[Tuple[bytes, Hiccup]]
+
+
+def _worker_hiccup(config: bytes) -> Hiccup:
+    global _worker_config
+    if _worker_config is None or _worker_config[0] != config:
+        _worker_config = (config, pickle.loads(config))
+    return _worker_config[1]
+
+
+def _run_chunk(config: bytes, query: Xpath, loader: Optional[Callable[[Any], Any]], locators: bool, chunk: Chunk) -> ChunkResult:
+    h = _worker_hiccup(config)
+    res = [] # type: ChunkResult
+    for idx, root in chunk:
+        obj = root if loader is None else loader(root)
+        with h.snapshot(obj, queries=[query]) as snap:
+            if locators:
+                found = [Locator(idx, p) for p in snap.locate(query)] # type: List[Any]
+            else:
+                found = snap.xquery(query)
+        res.append((idx, found))
+    return res
+
+
+def _chunks(roots: Iterable[Any], chunksize: int, skip: Set[int]) -> Iterator[Chunk]:
+    chunk = [] # type: Chunk
+    for i, root in enumerate(roots):
+        if i in skip:
+            continue
+        chunk.append((i, root))
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def xquery_corpus(
+        roots: Iterable[Any],
+        query: Xpath,
+        hiccup: Optional[Hiccup]=None,
+        loader: Optional[Callable[[Any], Any]]=None,
+        locators: bool=False,
+        ordered: bool=True,
+        chunksize: int=16,
+        max_workers: Optional[int]=None,
+        executor: Optional[Executor]=None,
+        index: Optional[CorpusIndex]=None,
+) -> Iterator[Tuple[int, List[Any]]]:
+    """
+    Runs the query against each of the roots in worker processes, yielding (root index, results) pairs.
+
+    hiccup: configuration to use (factories, exclusion rules, etc.), has to be picklable
+    loader: if passed, roots are arguments to it (e.g. filenames) and the objects are loaded in the workers.
+            Otherwise, the roots themselves are pickled and sent to the workers
+    locators: return Locator instead of the objects, useful if results aren't picklable or are expensive to send back
+    ordered: yield results in the order of roots. Otherwise, yield them as soon as they are ready
+    chunksize: number of roots sent to a worker at once
+    executor: pool to use instead of creating a new ProcessPoolExecutor
+    index: roots which the index proves can't match the query are skipped (and not yielded). Roots missing from the index are queried as usual.
+           It has to be built with the same configuration as hiccup
+    """
+    if chunksize < 1:
+        raise HiccupError('chunksize should be positive, got {}'.format(chunksize))
+    h = Hiccup() if hiccup is None else hiccup
+    try:
+        config = pickle.dumps(h)
+    except Exception as e:
+        raise HiccupError('Hiccup configuration has to be picklable: {}'.format(e)) from e
+
+    if index is not None and _conversion_config(index.hiccup) != _conversion_config(h):
+        raise HiccupError('index was built with a different Hiccup configuration')
+    skip = set() if index is None else index.roots - index.candidates(query)
+    workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+    own = executor is None
+    pool = ProcessPoolExecutor(max_workers=workers) if executor is None else executor
+    # don't submit the whole corpus at once, otherwise all the roots end up pickled in memory
+    window = 2 * workers
+    pending = deque() # type: Deque[Future]
+    try:
+        for chunk in _chunks(roots, chunksize, skip):
+            pending.append(pool.submit(_run_chunk, config, query, loader, locators, chunk))
+            if len(pending) >= window:
+                yield from _drain(pending, ordered)
+        while len(pending) > 0:
+            yield from _drain(pending, ordered)
+    finally:
+        for f in pending:
+            f.cancel()
+        if own:
+            pool.shutdown(wait=True)
+
+
+def _drain(pending: 'Deque[Future]', ordered: bool) -> Iterator[Tuple[int, List[Any]]]:
+    if ordered:
+        yield from pending.popleft().result()
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for f in done:
+        pending.remove(f)
+        yield from f.result()
@@ -1,20 +1,302 @@
+from collections import OrderedDict
 from inspect import getmro, isclass
-from typing import Set
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import functools
 import types
+import weakref
 """
 a copy of inspect.getmembers but capable of error handling
 TODO maybe, commit it to python? could it be useful??
 """
 
+try:
+    import dataclasses
+except ImportError:
+    # python < 3.7
+    dataclasses = None # type: ignore
+
+
 _inprogress = object()
 
 class InspectError(RuntimeError):
     pass
 
 
-def getmembers(object, path, excluded):
+class _Variants:
+    """
+    Small LRU cache of per class results, e.g. for different sets of instance attributes or exclusion rules.
+    Instances normally share the same set of attributes, but let's not blow up if they don't
+    """
+    def __init__(self, maxsize: int=64) -> None:
+        self.maxsize = maxsize
+        self._entries = OrderedDict() # type: OrderedDict
+
+    def get(self, key: Any) -> Optional[List[str]]:
+        res = self._entries.get(key, None)
+        if res is not None:
+            self._entries.move_to_end(key)
+        return res
+
+    def put(self, key: Any, value: List[str]) -> None:
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Schema:
+    """
+    Member layout shared by all instances of a class, so we don't have to call dir() for every single instance
+    """
+    def __init__(self, cls: type) -> None:
+        # not keeping the class (or its mro) itself, otherwise it would never be collected
+        self.signature = self._signature(cls)
+        self.names = dir(cls) # already sorted
+        self.data = set() # type: Set[str] # data descriptors (e.g. properties), these take precedence over instance __dict__
+        self.properties = [] # type: List[str]
+        for name in self.names:
+            for base in cls.__mro__:
+                if name in base.__dict__:
+                    v = base.__dict__[name]
+                    if _is_data_descriptor(v):
+                        self.data.add(name)
+                    if isinstance(v, _PROPERTIES):
+                        self.properties.append(name)
+                    break
+        # if class doesn't customize attribute access, we can take instance attributes straight from __dict__
+        self.plain_access = cls.__getattribute__ is object.__getattribute__ # type: ignore
+        self._merged = _Variants()
+        self._filtered = _Variants()
+        # declared fields, if the class declares them (dataclasses, attrs, namedtuples, __slots__)
+        self.fields = declared_fields(cls)
+        self._adapted = _Variants()
+
+    @staticmethod
+    def _signature(cls: type) -> Tuple[Tuple[int, int], ...]:
+        # ids are fine since the classes in mro of a live class are alive too
+        return tuple((id(c), len(c.__dict__)) for c in cls.__mro__)
+
+    def is_stale(self, cls: type) -> bool:
+        """
+        Cheap check to catch classes mutated at runtime. Won't detect attributes replaced in place though,
+        use invalidate() for that
+        """
+        return self._signature(cls) != self.signature
+
+    def instance_names(self, keys: Tuple[str, ...]) -> List[str]:
+        """
+        Equivalent of dir() for an instance with these __dict__ keys
+        """
+        res = self._merged.get(keys)
+        if res is None:
+            res = sorted(set(self.names).union(keys))
+            self._merged.put(keys, res)
+        return res
+
+    def filtered_names(self, keys: Tuple[str, ...], static_key: Any, static_excluded: Callable[[str], bool]) -> List[str]:
+        ck = (static_key, keys)
+        res = self._filtered.get(ck)
+        if res is None:
+            res = [n for n in self.instance_names(keys) if not static_excluded(n)]
+            self._filtered.put(ck, res)
+        return res
+
+    def field_names(self, properties: bool, static_key: Any=None, static_excluded: Optional[Callable[[str], bool]]=None) -> List[str]:
+        """
+        Declared fields (and optionally, properties) instead of everything dir() would return
+        """
+        assert self.fields is not None
+        ck = (static_key, properties)
+        cacheable = static_excluded is None or static_key is not None
+        res = self._adapted.get(ck) if cacheable else None
+        if res is None:
+            names = set(self.fields)
+            if properties:
+                names.update(self.properties)
+            res = sorted(n for n in names if static_excluded is None or not static_excluded(n))
+            if cacheable:
+                self._adapted.put(ck, res)
+        return res
+
+
+_PROPERTIES = (property,) + ((functools.cached_property,) if hasattr(functools, 'cached_property') else ()) # type: ignore
+
+
+def _slots(cls: type) -> Optional[List[str]]:
+    """
+    All slots of the class, or None if instances might have other attributes (i.e. have __dict__)
+    """
+    res = [] # type: List[str]
+    for c in cls.__mro__:
+        if c is object:
+            continue
+        slots = c.__dict__.get('__slots__', None)
+        if slots is None:
+            return None
+        if isinstance(slots, str):
+            slots = [slots]
+        for name in slots:
+            if name == '__dict__':
+                return None
+            if name == '__weakref__':
+                continue
+            if name.startswith('__') and not name.endswith('__'):
+                # private names are mangled
+                name = '_' + c.__name__.lstrip('_') + name
+            res.append(name)
+    return res
+
+
+def declared_fields(cls: type) -> Optional[List[str]]:
+    """
+    Fields of dataclasses, attrs classes, namedtuples and classes with __slots__, None for other classes
+    """
+    if dataclasses is not None and dataclasses.is_dataclass(cls):
+        return [f.name for f in dataclasses.fields(cls)]
+    attrs = cls.__dict__.get('__attrs_attrs__', None)
+    if attrs is not None:
+        return [a.name for a in attrs]
+    if is_namedtuple(cls):
+        return list(cls._fields) # type: ignore
+    return _slots(cls)
+
+
+def is_namedtuple(cls: type) -> bool:
+    return issubclass(cls, tuple) and isinstance(getattr(cls, '_fields', None), tuple)
+
+
+def _is_data_descriptor(v: Any) -> bool:
+    tp = type(v)
+    return hasattr(tp, '__set__') or hasattr(tp, '__delete__')
+
+
+_schemas = weakref.WeakKeyDictionary() # type: weakref.WeakKeyDictionary
+
+
+def get_schema(cls: type) -> Optional[Schema]:
+    """
+    None means we can't rely on the class layout (e.g. custom __dir__), so have to inspect each instance
+    """
+    res = _schemas.get(cls, None)
+    if res is not None and not res.is_stale(cls):
+        return res
+    if cls.__dir__ is not object.__dir__: # type: ignore
+        return None
+    try:
+        res = Schema(cls)
+        _schemas[cls] = res
+    except TypeError:
+        # not weakref-able, e.g. some extension types
+        return None
+    return res
+
+
+def invalidate(cls: Optional[type]=None) -> None:
+    """
+    Drops cached layout for the class (or all classes), necessary if you modify classes at runtime
+    """
+    if cls is None:
+        _schemas.clear()
+    else:
+        _schemas.pop(cls, None)
+
+
+def _getvalue(object, key: str, schema: Schema, dct: Optional[Dict[str, Any]]) -> Any:
+    if dct is not None and schema.plain_access and key not in schema.data:
+        try:
+            return dct[key]
+        except KeyError:
+            pass
+    return getattr(object, key)
+
+
+Timer = Callable[[str, float], None]
+
+
+def _timed_getvalue(timer: Timer):
+    def get(object, key: str, schema: Schema, dct: Optional[Dict[str, Any]]) -> Any:
+        start = perf_counter()
+        try:
+            return _getvalue(object, key, schema, dct)
+        finally:
+            timer(key, perf_counter() - start)
+    return get
+
+
+def getmembers(
+        object,
+        path,
+        excluded,
+        static_excluded: Optional[Callable[[str], bool]]=None,
+        static_key: Any=None,
+        timer: Optional[Timer]=None,
+        cache: Optional[Callable[[Any, str, Callable[[], Any]], Any]]=None,
+        fields: bool=False,
+        properties: bool=True,
+):
     """Return all members of an object as (name, value) pairs sorted by name.
-    Optionally, only return members that satisfy a given predicate."""
+    Optionally, only return members that satisfy a given predicate.
+
+    static_excluded: check which only depends on the member name (and the object type), so we can avoid evaluating the value
+    static_key: identifies static_excluded by equality, so its results are cached along with the class layout. Hashable values, not the rules themselves
+    timer: called with the member name and the time it took to get its value
+    cache: called with the object, member name and function computing the value, returns the value.
+           Not used for classes and objects with custom __dir__
+    fields: for classes with declared fields (see declared_fields), only return them instead of everything dir() would
+    properties: along with fields, return properties
+    """
+    schema = None if isclass(object) else get_schema(type(object))
+    if schema is None:
+        return _getmembers(object, path=path, excluded=excluded, static_excluded=static_excluded, timer=timer)
+
+    dct = getattr(object, '__dict__', None)
+    keys = () # type: Tuple[str, ...]
+    if not isinstance(dct, dict):
+        dct = None
+    else:
+        keys = tuple(dct)
+    if fields and schema.fields is not None:
+        names = schema.field_names(properties, static_key=static_key, static_excluded=static_excluded)
+    elif static_excluded is None:
+        names = schema.instance_names(keys)
+    elif static_key is None:
+        names = [n for n in schema.instance_names(keys) if not static_excluded(n)]
+    else:
+        names = schema.filtered_names(keys, static_key, static_excluded)
+
+    get = _getvalue if timer is None else _timed_getvalue(timer)
+    results = []
+    # path is extended in place rather than copied, which matters for deep objects
+    path.append(None)
+    for key in names:
+        path[-1] = (key, _inprogress)
+        if excluded(path):
+            continue
+        try:
+            if cache is None:
+                value = get(object, key, schema, dct)
+            else:
+                value = cache(object, key, lambda: get(object, key, schema, dct)) # pylint: disable=cell-var-from-loop
+        except AttributeError:
+            # could be a (currently) missing slot member, or a buggy __dir__; discard and move on
+            continue
+        except Exception as ex:
+            try:
+                raise InspectError from ex
+            except InspectError as ie:
+                value = ie
+        path[-1] = (key, value)
+        if isinstance(value, InspectError) or not excluded(path):
+            results.append((key, value))
+    path.pop()
+    # names are sorted already
+    return results
+
+
+def _getmembers(object, path, excluded, static_excluded, timer: Optional[Timer]=None):
     if isclass(object):
         mro = (object,) + getmro(object)
     else:
@@ -33,11 +315,14 @@ def getmembers(object, path, excluded):
     except AttributeError:
         pass
     for key in names:
+        if static_excluded is not None and static_excluded(key):
+            continue
         if excluded(path + [(key, _inprogress)]):
             continue
         # First try to get the value via getattr.  Some descriptors don't
         # like calling their __get__ (see bug #1785), so fall back to
         # looking in the __dict__.
+        start = perf_counter()
         try:
             value = getattr(object, key)
             # handle the duplicate key
@@ -58,6 +343,8 @@ def getmembers(object, path, excluded):
                 raise InspectError from ex
             except InspectError as ie:
                 value = ie
+        if timer is not None:
+            timer(key, perf_counter() - start)
         if isinstance(value, InspectError) or not excluded(path + [(key, value)]):
             results.append((key, value))
         processed.add(key)
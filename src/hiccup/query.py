@@ -0,0 +1,457 @@
+import re
+from functools import lru_cache
+from typing import List, Optional, Set, Tuple # noqa: F401 Set is only used in type comments
+"""
+Static analysis of xpath queries, used to avoid converting parts of the object graph the query can't possibly look at.
+
+The analysis is conservative: whenever we're unsure (unknown functions, descendant axes, string values of elements, etc.),
+we assume the query might need everything.
+"""
+
+Xpath = str
+Depth = Optional[int] # None means 'unknown', so potentially unbounded
+
+
+class QueryAnalysis:
+    def __init__(self) -> None:
+        """
+        Maximum depth of the elements query can reach (root element has depth 1). None means unbounded.
+        """
+        self.max_depth = 0 # type: Depth
+        """
+        Element names the query can select or test. None means that any element might be relevant (e.g. due to wildcards).
+        """
+        self.names = set() # type: Optional[Set[str]]
+        """
+        Element names which have to be present in the document for the query to return anything.
+        """
+        self.required_names = set() # type: Set[str]
+        """
+        Pairs of element name and text: an element with that name and exactly that text has to be present for the query to return anything.
+        """
+        self.required_texts = set() # type: Set[Tuple[str, str]]
+
+    def _need(self, depth: Depth) -> None:
+        if depth is None or self.max_depth is None:
+            self.max_depth = None
+        else:
+            self.max_depth = max(self.max_depth, depth)
+
+    def _unbounded(self) -> None:
+        self._need(None)
+
+    def _name(self, name: Optional[str]) -> None:
+        if name is None or self.names is None:
+            self.names = None
+        else:
+            self.names.add(name)
+
+    def _everything(self) -> None:
+        self._unbounded()
+        self._name(None)
+
+    def merge(self, other: 'QueryAnalysis') -> 'QueryAnalysis':
+        res = QueryAnalysis()
+        res._need(self.max_depth)
+        res._need(other.max_depth)
+        for names in (self.names, other.names):
+            if names is None:
+                res._name(None)
+            else:
+                for n in names:
+                    res._name(n)
+        # results of either of the queries are fine
+        res.required_names = self.required_names & other.required_names
+        res.required_texts = self.required_texts & other.required_texts
+        return res
+
+
+class _ParseError(Exception):
+    pass
+
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<lit>"[^"]*"|'[^']*')
+  | (?P<num>\d+(?:\.\d*)?|\.\d+)
+  | (?P<var>\$[^\W\d][\w.\-]*(?::[^\W\d][\w.\-]*)?)
+  | (?P<punct>//|::|\.\.|!=|<=|>=|[/()\[\].@,|+\-=<>*])
+  | (?P<name>[^\W\d][\w.\-]*(?::[^\W\d][\w.\-]*|:\*)?)
+)''', re.VERBOSE)
+
+_OPERATORS = {'/', '//', '|', '+', '-', '=', '!=', '<', '<=', '>', '>=', 'and', 'or', 'div', 'mod', '*'}
+_OPERATOR_NAMES = {'and', 'or', 'div', 'mod'}
+_NODE_TYPES = {'node', 'text', 'comment', 'processing-instruction'}
+_AXES = {
+    'ancestor', 'ancestor-or-self', 'attribute', 'child', 'descendant', 'descendant-or-self',
+    'following', 'following-sibling', 'namespace', 'parent', 'preceding', 'preceding-sibling', 'self',
+}
+# functions which work on the context node when called without arguments
+_CONTEXT_STRING_FUNCTIONS = {'string', 'string-length', 'normalize-space', 'number'}
+# functions which only look at nodes themselves, but not at their string values
+_NODESET_FUNCTIONS = {'count', 'not', 'boolean', 'name', 'local-name', 'namespace-uri'}
+_CORE_FUNCTIONS = _NODESET_FUNCTIONS | {
+    'last', 'position', 'id', 'string', 'concat', 'starts-with', 'contains', 'substring-before', 'substring-after',
+    'substring', 'string-length', 'normalize-space', 'translate', 'true', 'false', 'lang', 'number', 'sum',
+    'floor', 'ceiling', 'round',
+}
+
+Token = Tuple[str, str] # kind, text
+
+
+def _tokenize(query: Xpath) -> List[Token]:
+    res = [] # type: List[Token]
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        m = _TOKEN.match(query, pos)
+        if m is None or m.end() == pos:
+            raise _ParseError(query[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        assert kind is not None
+        text = m.group(kind)
+        # see https://www.w3.org/TR/xpath-10/#exprlex, disambiguating operators from name tests
+        if text == '*' or (kind == 'name' and text in _OPERATOR_NAMES):
+            if len(res) > 0 and res[-1][1] not in {'@', '::', '(', '[', ','} and res[-1][1] not in _OPERATORS:
+                kind = 'op'
+            else:
+                kind = 'name'
+        elif kind == 'punct' and text in _OPERATORS:
+            kind = 'op'
+        res.append((kind, text))
+    return res
+
+
+# element name and text (None if we only know that the element has to be present)
+_Requirement = Tuple[str, Optional[str]]
+# predicates which require the context element to have the literal (None) as its text
+_TEXT_TESTS = [
+    ['text', '(', ')', '=', None, ']'],
+    [None, '=', 'text', '(', ')', ']'],
+    ['.', '/', 'text', '(', ')', '=', None, ']'],
+    [None, '=', '.', '/', 'text', '(', ')', ']'],
+] # type: List[List[Optional[str]]]
+
+
+# result of a subexpression: depth of the resulting nodes and whether they are elements
+# the latter matters, because string value of an element depends on all of its descendants
+_Value = Tuple[Depth, bool]
+
+
+class _Parser:
+    """
+    Recursive descent over https://www.w3.org/TR/xpath-10/ grammar, computing QueryAnalysis along the way.
+    """
+    def __init__(self, tokens: List[Token], res: QueryAnalysis) -> None:
+        self.tokens = tokens
+        self.pos = 0
+        self.res = res
+        # things the query can't match without. Subexpressions which don't have to be non-empty for the query to match
+        # (e.g. operands of 'or', function arguments) drop whatever they added
+        self.required = [] # type: List[_Requirement]
+        # name test of the step whose predicate we're in
+        self.context_name = None # type: Optional[str]
+
+    def peek(self, offset: int=0) -> Optional[str]:
+        i = self.pos + offset
+        if i < len(self.tokens):
+            return self.tokens[i][1]
+        return None
+
+    def peek_kind(self, offset: int=0) -> Optional[str]:
+        i = self.pos + offset
+        if i < len(self.tokens):
+            return self.tokens[i][0]
+        return None
+
+    def advance(self) -> str:
+        if self.pos >= len(self.tokens):
+            raise _ParseError('unexpected end of query')
+        t = self.tokens[self.pos][1]
+        self.pos += 1
+        return t
+
+    def expect(self, text: str) -> None:
+        t = self.advance()
+        if t != text:
+            raise _ParseError('expected {}, got {}'.format(text, t))
+
+    def at_op(self, *ops: str) -> bool:
+        return self.peek_kind() == 'op' and self.peek() in ops
+
+    def as_value(self, v: _Value) -> None:
+        """
+        Marks the subexpression as converted to string/number, e.g. compared against something
+        """
+        if v[1]:
+            self.res._everything()
+
+    def parse(self, depth: Depth) -> None:
+        self.expr(depth)
+        if self.pos != len(self.tokens):
+            raise _ParseError('trailing tokens')
+        for name, text in self.required:
+            if text is None:
+                self.res.required_names.add(name)
+            else:
+                self.res.required_texts.add((name, text))
+
+    def expr(self, depth: Depth) -> _Value:
+        return self._boolean(depth, 'or', lambda: self._boolean(depth, 'and', lambda: self.equality(depth)))
+
+    def _boolean(self, depth: Depth, op: str, operand) -> _Value:
+        start = len(self.required)
+        v = operand()
+        while self.at_op(op):
+            self.advance()
+            operand()
+            # node sets are converted to boolean, which only depends on their emptiness
+            v = (None, False)
+            if op == 'or':
+                del self.required[start:]
+        return v
+
+    def _binary(self, ops, operand, comparison: bool=False) -> _Value:
+        start = len(self.required)
+        literals = 0
+        operands = 0
+        v = None # type: Optional[_Value]
+        while v is None or self.at_op(*ops):
+            if v is not None:
+                self.advance()
+                self.as_value(v)
+            pos = self.pos
+            o = operand()
+            operands += 1
+            if self.pos - pos == 1 and self.tokens[pos][0] in {'lit', 'num'}:
+                literals += 1
+            if v is None:
+                v = o
+            else:
+                self.as_value(o)
+                v = (None, False)
+        if operands > 1:
+            # comparing a node set against a literal is false if the node set is empty, but in general anything goes
+            # (e.g. 'x = false()' or arithmetic on NaNs)
+            if not (comparison and operands == 2 and literals == 1):
+                del self.required[start:]
+        assert v is not None
+        return v
+
+    def equality(self, depth: Depth) -> _Value:
+        return self._binary(('=', '!='), lambda: self.relational(depth), comparison=True)
+
+    def relational(self, depth: Depth) -> _Value:
+        return self._binary(('<', '<=', '>', '>='), lambda: self.additive(depth), comparison=True)
+
+    def additive(self, depth: Depth) -> _Value:
+        return self._binary(('+', '-'), lambda: self.multiplicative(depth))
+
+    def multiplicative(self, depth: Depth) -> _Value:
+        return self._binary(('*', 'div', 'mod'), lambda: self.unary(depth))
+
+    def unary(self, depth: Depth) -> _Value:
+        if self.at_op('-'):
+            self.advance()
+            start = len(self.required)
+            self.as_value(self.unary(depth))
+            del self.required[start:]
+            return (None, False)
+        return self.union(depth)
+
+    def union(self, depth: Depth) -> _Value:
+        start = len(self.required)
+        v = self.path(depth)
+        while self.at_op('|'):
+            self.advance()
+            o = self.path(depth)
+            vd, od = v[0], o[0]
+            v = (None if vd is None or od is None else max(vd, od), v[1] or o[1])
+            del self.required[start:]
+        return v
+
+    def path(self, depth: Depth) -> _Value:
+        kind = self.peek_kind()
+        tok = self.peek()
+        if kind in {'lit', 'num', 'var'} or tok == '(' or (kind == 'name' and self.peek(1) == '(' and tok not in _NODE_TYPES):
+            v = self.filter(depth)
+            if self.at_op('/', '//'):
+                return self.relative(v[0])
+            return v
+        return self.location(depth)
+
+    def filter(self, depth: Depth) -> _Value:
+        kind = self.peek_kind()
+        tok = self.advance()
+        if kind in {'lit', 'num'}:
+            v = (depth, False) # type: _Value
+        elif kind == 'var':
+            # no idea what's in there
+            self.res._everything()
+            v = (None, False)
+        elif tok == '(':
+            v = self.expr(depth)
+            self.expect(')')
+        else:
+            v = self.function(tok, depth)
+        # predicates apply to whatever the expression returns, not to the enclosing step
+        context_name = self.context_name
+        self.context_name = None
+        while self.peek() == '[':
+            self.predicate(v[0])
+        self.context_name = context_name
+        return v
+
+    def function(self, name: str, depth: Depth) -> _Value:
+        if name not in _CORE_FUNCTIONS:
+            # extension functions might be looking at anything
+            self.res._everything()
+        self.expect('(')
+        start = len(self.required)
+        if self.peek() == ')' and name in _CONTEXT_STRING_FUNCTIONS:
+            # without arguments, these take string value of the context element, i.e. depend on all its descendants
+            self.as_value((depth, True))
+        while self.peek() != ')':
+            a = self.expr(depth)
+            del self.required[start:]
+            if name not in _NODESET_FUNCTIONS:
+                self.as_value(a)
+            if self.peek() == ',':
+                self.advance()
+        self.expect(')')
+        if name == 'id':
+            return (None, True)
+        return (None, False)
+
+    def predicate(self, depth: Depth) -> None:
+        self.expect('[')
+        text = self.text_test()
+        if text is not None and self.context_name is not None:
+            self.required.append((self.context_name, text))
+        # predicate is either positional or converted to boolean, so no string values involved
+        self.expr(depth)
+        self.expect(']')
+
+    def text_test(self) -> Optional[str]:
+        """
+        If predicate is just comparing text() against a literal, returns the literal
+        """
+        for pattern in _TEXT_TESTS:
+            toks = self.tokens[self.pos: self.pos + len(pattern)]
+            if len(toks) != len(pattern):
+                continue
+            lit = None
+            for (kind, text), p in zip(toks, pattern):
+                if p is None and kind == 'lit':
+                    lit = text[1:-1]
+                elif p != text:
+                    break
+            else:
+                return lit
+        return None
+
+    def location(self, depth: Depth) -> _Value:
+        tok = self.peek()
+        if tok == '/':
+            self.advance()
+            if self.at_step():
+                return self.relative(0, first=True)
+            return (0, False)
+        if tok == '//':
+            return self.relative(0)
+        return self.relative(depth, first=True)
+
+    def at_step(self) -> bool:
+        kind = self.peek_kind()
+        return kind == 'name' or self.peek() in {'.', '..', '@'}
+
+    def relative(self, depth: Depth, first: bool=False) -> _Value:
+        v = (depth, False) # type: _Value
+        while True:
+            if first:
+                first = False
+            elif self.at_op('/'):
+                self.advance()
+            elif self.at_op('//'):
+                self.advance()
+                self.res._unbounded()
+                v = (None, v[1])
+            else:
+                return v
+            v = self.step(v[0])
+
+    def step(self, depth: Depth) -> _Value:
+        tok = self.advance()
+        if tok == '.':
+            return (depth, True)
+        if tok == '..':
+            return (None if depth is None else max(depth - 1, 0), True)
+
+        axis = 'child'
+        if tok == '@':
+            axis = 'attribute'
+            tok = self.advance()
+        elif self.peek() == '::':
+            if tok not in _AXES:
+                raise _ParseError('unknown axis ' + tok)
+            axis = tok
+            self.advance()
+            tok = self.advance()
+
+        elements = True
+        name_test = False
+        if self.peek() == '(' and tok in _NODE_TYPES:
+            self.advance()
+            if self.peek_kind() == 'lit':
+                self.advance()
+            self.expect(')')
+            elements = tok == 'node'
+            if elements:
+                self.res._name(None)
+        elif axis not in {'attribute', 'namespace'}:
+            wildcard = tok == '*' or tok.endswith(':*')
+            self.res._name(None if wildcard else tok)
+            if not wildcard and ':' not in tok:
+                self.required.append((tok, None))
+                name_test = True
+
+        if axis == 'child':
+            ndepth = None if depth is None else depth + 1
+            if elements:
+                self.res._need(ndepth)
+            # otherwise, it's a text node, contained in the context element
+        elif axis in {'self', 'following-sibling', 'preceding-sibling', 'ancestor', 'ancestor-or-self'}:
+            # for ancestors, it's an upper bound
+            ndepth = depth
+        elif axis == 'parent':
+            ndepth = None if depth is None else max(depth - 1, 0)
+        elif axis in {'attribute', 'namespace'}:
+            ndepth = depth
+            elements = False
+        else:
+            # descendants, following, preceding
+            self.res._unbounded()
+            ndepth = None
+
+        context_name = self.context_name
+        # node() matches elements with any name
+        self.context_name = tok if elements and name_test else None
+        while self.peek() == '[':
+            self.predicate(ndepth)
+        self.context_name = context_name
+        return (ndepth, elements)
+
+
+@lru_cache(maxsize=1024)
+def analyze(query: Xpath) -> QueryAnalysis:
+    """
+    Query is assumed to be evaluated against the root element, same way Hiccup.xquery does
+    """
+    res = QueryAnalysis()
+    try:
+        _Parser(_tokenize(query), res).parse(depth=1)
+    except _ParseError:
+        # let lxml deal with it later, for now just be conservative
+        res = QueryAnalysis()
+        res._everything()
+    return res
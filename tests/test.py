@@ -3,10 +3,12 @@
 
 import re
 
+import pytest
 from lxml import etree as ET
 
-from hiccup import Hiccup, xfind, xfind_all
-from hiccup import IfParentType, IfName
+from hiccup import Hiccup, HiccupError, ValueCache, xfind, xfind_all
+from hiccup import IfParentType, IfName, IfNameMatches, IfType, IfValueMatches
+from hiccup.corpus import xquery_corpus, resolve, build_index, CorpusIndex
 
 __author__ = "Dima Gerasimov"
 __copyright__ = "Dima Gerasimov"
@@ -302,3 +304,832 @@ def test_exclude_member():
     assert h.xfind(a, '//include') == 'included'
 
     assert not triggered[0]
+
+
+def test_snapshot():
+    converted = [0]
+
+    class A:
+        def __init__(self) -> None:
+            self.x = 'xxx'
+            self.ys = ['y1', 'y2']
+
+        @property
+        def prop(self):
+            converted[0] += 1
+            return 'prop'
+
+    a = A()
+    snap = Hiccup().snapshot(a)
+    assert converted[0] == 1
+
+    assert snap.xfind('/A') is a
+    assert snap.xfind('//x') == 'xxx'
+    assert snap.xfind_all('//ys/*') == ['y1', 'y2']
+    assert snap.xfind('//prop') == 'prop'
+    # queries don't trigger conversion again
+    assert converted[0] == 1
+
+
+def test_xpath_cache():
+    tt = Tree('aaa', Tree('left'), Tree('right'))
+
+    h = Hiccup()
+    h.xpath_cache.maxsize = 2
+    h.prewarm(['//Tree', '//node'])
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (0, 2)
+
+    assert len(h.xquery(tt, '//Tree')) == 3
+    assert len(h.xquery(tt, '//node')) == 3
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (2, 2)
+
+    h.xquery(tt, '/Tree')
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (2, 3)
+    # least recently used query got evicted
+    assert len(h.xpath_cache) == 2
+    h.xquery(tt, '//Tree')
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (2, 4)
+
+    h.xpath_namespaces = {'x': 'whatever'}
+    h.xquery(tt, '/Tree')
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (2, 5)
+
+    # prewarmed with the namespaces and extensions queries actually use
+    h.compact_sequences = 100
+    h.prewarm(['//node'])
+    h.xquery(tt, '//node')
+    assert (h.xpath_cache.hits, h.xpath_cache.misses) == (3, 6)
+
+
+def test_lazy():
+    triggered = []
+
+    class A:
+        def __init__(self, child) -> None:
+            self.child = child
+
+        @property
+        def expensive(self):
+            triggered.append(self)
+            return 'expensive'
+
+    a = A(A(None))
+
+    h = Hiccup()
+    h.lazy = True
+    assert h.xfind(a, '/A/child') is a.child
+    # nested object wasn't expanded
+    assert triggered == [a]
+
+    del triggered[:]
+    assert h.xfind(a, '/A/child[expensive/text()="expensive"]') is a.child
+    assert triggered == [a, a.child]
+
+    snap = h.snapshot(a, queries=['/A'])
+    assert snap.xfind('/A') is a
+    with pytest.raises(HiccupError):
+        snap.xfind('/A/child')
+
+    # queries which can reach anything still result in full conversion
+    assert len(h.xfind_all(a, '//expensive')) == 2
+
+    # without arguments, these functions take string value of the whole element
+    tt = Tree('aaa', Tree('left'), Tree('right'))
+    for query in ['/Tree[string-length() > 5]', '/Tree[normalize-space()="leftrightaaa"]', '/Tree/children/Tree[string()="left"]']:
+        assert h.xquery(tt, query) == Hiccup().xquery(tt, query)
+        assert len(h.xquery(tt, query)) == 1
+
+
+def test_query_depth():
+    from hiccup.query import analyze
+    assert analyze('/Tree').max_depth == 1
+    assert analyze('/Tree/node').max_depth == 2
+    assert analyze('/Tree/children/*[2]').max_depth == 3
+    assert analyze('/A[x/text() = "v"]').max_depth == 2
+    assert analyze('/A[count(b/c) > 1]').max_depth == 3
+    # string value of an element depends on all descendants
+    assert analyze('/A[x = "v"]').max_depth is None
+    assert analyze('//Tree').max_depth is None
+    assert analyze('/A/descendant::b').max_depth is None
+    assert analyze('/A[ext:whatever()]').max_depth is None
+    assert analyze('/A[string-length() > 5]').max_depth is None
+    assert analyze('/A[number() = 1]').max_depth is None
+    assert analyze('/A[string-length(name()) = 1]').max_depth == 1
+
+    assert analyze('//Tree[./node[text()="left"]]').names == {'Tree', 'node'}
+    assert analyze('/A/b/..').names == {'A', 'b'}
+    assert analyze('/A/*').names is None
+    assert analyze('/A/node()').names is None
+    assert analyze('/A[x = "v"]').names is None
+
+
+def test_prune():
+    triggered = []
+
+    class A:
+        def __init__(self, child) -> None:
+            self.child = child
+            self.text = 'text'
+
+        @property
+        def expensive(self):
+            triggered.append(self)
+            return 'expensive'
+
+    a = A(A(None))
+
+    h = Hiccup()
+    h.prune = True
+
+    assert h.xfind(a, '/A/child/text') == 'text'
+    # no descendant axes, so unmentioned members aren't even evaluated
+    assert triggered == []
+
+    snap = h.snapshot(a, queries=['//text'])
+    assert len(snap.xfind_all('//text')) == 2
+    # here we can only prune primitive values
+    assert triggered == [a, a.child]
+    with pytest.raises(HiccupError):
+        snap.xfind_all('//expensive')
+
+    # wildcards need everything
+    assert len(h.xfind_all(a, '//*[text()="expensive"]')) == 2
+
+    # so do string functions without arguments, they take string value of the whole element
+    tt = Tree('aaa', Tree('left'), Tree('right'))
+    for query in ['/Tree[string()="leftrightaaa"]', '//Tree[normalize-space()="left"]']:
+        assert h.xquery(tt, query) == Hiccup().xquery(tt, query)
+        assert len(h.xquery(tt, query)) == 1
+
+
+def test_class_mutated():
+    class A:
+        def __init__(self) -> None:
+            self.x = 'x'
+
+    h = Hiccup()
+    a = A()
+    assert h.xfind_all(a, '//y') == []
+
+    A.y = 'y'
+    assert h.xfind(a, '//y') == 'y'
+
+    # replacing attributes in place isn't detected automatically
+    A.y = property(lambda self: 'prop')
+    from hiccup import myinspect
+    myinspect.invalidate(A)
+    assert h.xfind(a, '//y') == 'prop'
+
+
+def test_exclude_rules():
+    class A:
+        def __init__(self) -> None:
+            self.x = 'x'
+            self.y = 'y'
+            self.z = 123
+            self.skip_me = 'skipped'
+            self.skip_you = 'skipped'
+            self.child = B()
+
+    class B:
+        def __init__(self) -> None:
+            self.x = 'bx'
+            self.y = 'by'
+
+    h = Hiccup()
+    h.exclude(IfParentType(A), IfName('x'))
+    h.exclude(IfNameMatches('skip_.*'))
+    h.exclude(IfType(int))
+    h.exclude(lambda ctx: ctx[-1][1] == 'by')
+    h.exclude(IfParentType(B), IfValueMatches(lambda v: v == 'bx'), lambda ctx: False)
+
+    assert h.as_xml(A()) == Xml('''
+<A>
+    <child>
+        <x>bx</x>
+    </child>
+    <y>y</y>
+</A>
+    ''')
+
+    # inline flags can't be merged with other regexes
+    h.exclude(IfNameMatches('(?i)CHILD'))
+    assert [x.tag for x in h.as_xml(A())] == ['y']
+
+    # layouts cache excluded names by the rules, not by Hiccup instances
+    from hiccup import myinspect
+    xfind_all(A(), '//y')
+    cached = len(myinspect.get_schema(A)._filtered)
+    for _ in range(100):
+        xfind_all(A(), '//y')
+    assert len(myinspect.get_schema(A)._filtered) == cached
+
+
+def test_dedup():
+    class X:
+        def __init__(self):
+            self.inf = None
+            self.value = 'value'
+    a = X()
+    a.inf = a
+
+    h = Hiccup()
+    h.dedup = 'cycles'
+    xml = h.as_xml(a)
+    assert [x.tag for x in xml] == ['inf', 'value']
+    assert xml[0].attrib['_ref'] == str(id(a))
+    assert h.xfind(a, '//inf') is a
+
+    shared = X()
+    ll = [shared, [shared]]
+    assert len(h.xfind_all(ll, '//value')) == 2
+
+    h.dedup = 'shared'
+    assert len(h.xfind_all(ll, '//value')) == 1
+    assert h.xfind_all(ll, '//X[@_ref]') == [shared]
+
+
+def test_keeper():
+    tt = Tree('aaa', Tree('left'), Tree('right'))
+
+    h = Hiccup()
+    assert len(h.xfind_all(tt, '//Tree')) == 3
+    # objects aren't kept after query
+    assert h.keeper_size() == 0
+
+    with h.snapshot(tt) as snap:
+        assert h.keeper_size() > 0
+        assert snap.xfind('/Tree') is tt
+    assert h.keeper_size() == 0
+    with pytest.raises(HiccupError):
+        snap.xfind('/Tree')
+
+    snap = h.snapshot(tt)
+    assert h.keeper_size() > 0
+    snap.close()
+    assert h.keeper_size() == 0
+
+
+def test_no_python_id():
+    left = Tree('left')
+    tt = Tree('aaa', left, Tree('right'))
+
+    h = Hiccup()
+    h.python_id_attr = None
+    with h.snapshot(tt) as snap:
+        assert snap.xml.xpath('//@_python_id') == []
+        assert snap.xfind('//Tree[./node[text()="left"]]') is left
+        with pytest.raises(HiccupError):
+            snap.xfind('//node/text()')
+
+
+def test_remove_control_characters():
+    from hiccup import remove_control_characters
+    import unicodedata
+
+    def reference(s):
+        return "".join(ch for ch in s if unicodedata.category(ch)[0] != "C")
+
+    for s in [
+            '',
+            'plain ascii',
+            'tab\tnewline\n\x0b\x7f',
+            'юникод\u200b with zero width space',
+            'private use \ue000 and unassigned \U000e0080',
+    ]:
+        assert remove_control_characters(s) == reference(s)
+
+
+def test_deep():
+    import sys
+    depth = sys.getrecursionlimit() * 2
+
+    class Link:
+        def __init__(self, value, next) -> None:
+            self.value = value
+            self.next = next
+
+    ll = None
+    for i in range(depth):
+        ll = Link(i, ll)
+
+    res = xfind(ll, '/Link/next/next/value')
+    assert res == depth - 3
+
+
+def test_cycle():
+    import datetime
+
+    class X:
+        def __init__(self) -> None:
+            self.value = 'value'
+            self.me = self
+
+    h = Hiccup()
+    with pytest.raises(HiccupError, match='cycle'):
+        h.as_xml(X())
+    # date.max.max is date.max
+    with pytest.raises(HiccupError, match='cycle'):
+        h.as_xml(datetime.date(2020, 1, 1))
+
+    h.dedup = 'cycles'
+    assert h.xquery(X(), '//value') == ['value']
+
+
+def test_xquery_limit():
+    left = Tree('left')
+    right = Tree('right')
+    tt = Tree('aaa', left, right)
+
+    h = Hiccup()
+    assert h.xquery(tt, '//Tree', limit=2) == [tt, left]
+    assert h.xquery(tt, '//Tree[./node[text()!="aaa"]] | /Tree', limit=2) == [tt, left]
+
+    it = h.xquery_iter(tt, '//node')
+    # attributes are sorted, so children go first
+    assert next(it) == 'left'
+    assert list(it) == ['right', 'aaa']
+
+    with pytest.raises(HiccupError, match='expected single result'):
+        h.xfind(tt, '//Tree')
+
+
+def test_xquery_many():
+    left = Tree('left')
+    right = Tree('right')
+    tt = Tree('aaa', left, right)
+
+    res = Hiccup().xquery_many(tt, {
+        'trees'   : '//Tree',
+        'trees2'  : '//Tree',
+        'nodes'   : '//node',
+        'left'    : '//Tree[./node[text()="left"]]',
+        'missing' : '//missing',
+    })
+    assert res == {
+        'trees'   : [tt, left, right],
+        'trees2'  : [tt, left, right],
+        'nodes'   : ['left', 'right', 'aaa'],
+        'left'    : [left],
+        'missing' : [],
+    }
+
+
+def test_refresh():
+    class Node:
+        def __init__(self, name, *children) -> None:
+            self.name = name
+            self.children = list(children)
+
+    a = Node('a')
+    b = Node('b')
+    root = Node('root', a, b)
+    with Hiccup().snapshot(root) as snap:
+        name_el = snap.xml.find('name')
+        assert sorted(snap.xquery('//Node/name')) == ['a', 'b', 'root']
+
+        c = Node('c')
+        root.children.append(c)
+        snap.mark_dirty(root.children)
+        assert snap.refresh() == 1
+        assert sorted(snap.xquery('//Node/name')) == ['a', 'b', 'c', 'root']
+        assert snap.xquery_single('//Node[name="c"]') is c
+        assert snap.xml.find('name') is name_el # untouched elements are reused
+
+        b.name = 'bb'
+        assert snap.refresh() == 0 # not marked, so nothing to do
+        assert snap.refresh(detect=True) == 1
+        assert sorted(snap.xquery('//Node/name')) == ['a', 'bb', 'c', 'root']
+
+        a.extra = Node('x')
+        root.children.remove(c)
+        assert snap.refresh(detect=True) == 1 # whole list is rebuilt, including the modified item
+        assert sorted(snap.xquery('//Node/name')) == ['a', 'bb', 'root']
+        assert snap.xquery('//extra/name') == ['x']
+        assert snap.refresh(detect=True) == 0
+        assert snap.xml.find('name') is name_el
+    with pytest.raises(HiccupError, match='closed'):
+        snap.refresh()
+
+    # the only full conversion of a shared object can be the one which goes away
+    class S:
+        def __init__(self) -> None:
+            self.v = 1
+
+    shared = S()
+    data = {'a': [shared], 'b': [shared]}
+    h = Hiccup()
+    h.dedup = 'shared'
+    with h.snapshot(data) as snap:
+        assert snap.xquery('//v') == [1]
+        data['a'].remove(shared)
+        snap.mark_dirty(data['a'])
+        snap.refresh()
+        assert snap.xquery('//v') == h.xquery(data, '//v') == [1]
+
+
+def test_subscribe():
+    class Todo:
+        def __init__(self, title, done=False) -> None:
+            self.title = title
+            self.done = done
+
+    first = Todo('first')
+    second = Todo('second', done=True)
+    todos = [first, second]
+    with Hiccup().snapshot(todos) as snap:
+        changes = []
+        new = snap.subscribe('//Todo', callback=lambda s: changes.append((s.added, s.removed)))
+        pending = snap.subscribe('//Todo[done="false"]')
+        assert pending.results == [first]
+
+        third = Todo('third')
+        todos.append(third)
+        snap.mark_dirty(todos)
+        snap.refresh()
+        assert (new.added, new.removed) == ([third], [])
+        assert (pending.added, pending.removed) == ([third], [])
+
+        first.done = True
+        snap.refresh(detect=True)
+        assert (new.added, new.removed) == ([], [])
+        assert (pending.added, pending.removed) == ([], [first])
+
+        todos.remove(second)
+        snap.mark_dirty(todos)
+        snap.refresh()
+        assert (new.added, new.removed) == ([], [second])
+        assert (pending.added, pending.removed) == ([], [])
+
+        assert changes == [([third], []), ([], [second])]
+
+
+def test_corpus():
+    roots = [{'items': ['a' * i, 'b']} for i in range(20)]
+    h = Hiccup()
+    h.exclude(IfName('skipped'))
+
+    res = list(xquery_corpus(roots, '//items/primitivish[1]', hiccup=h, chunksize=3, max_workers=2))
+    assert res == [(i, ['a' * i]) for i in range(20)]
+
+    res = list(xquery_corpus(roots, '//primitivish', hiccup=h, locators=True, ordered=False, max_workers=2))
+    assert sorted(i for i, _ in res) == list(range(20))
+    for i, locs in res:
+        assert [resolve(loc, roots[i], hiccup=h) for loc in locs] == roots[i]['items']
+
+
+def rename_x(xml: ET.Element) -> None:
+    for el in xml.iter('x'):
+        el.tag = 'renamed'
+
+
+def test_corpus_index(tmp_path):
+    roots = [
+        Tree('aaa', Tree('left'), Tree('right')),
+        Tree('bbb', Tree('right')),
+        Tree('left'),
+        [1, 2, 3],
+    ]
+    index = build_index(roots)
+    assert index.candidates('//Tree[./node[text()="left"]]') == {0, 2}
+    assert index.candidates('//Tree[./node[text()="right"]]/children') == {0, 1}
+    assert index.candidates('//node') == {0, 1, 2}
+    assert index.candidates('//node | //primitivish') == {0, 1, 2, 3} # either is fine
+    assert index.candidates('//Tree[not(./node[text()="left"])]') == {0, 1, 2}
+    assert index.candidates('//missing') == set()
+
+    path = str(tmp_path / 'index.pickle')
+    index.save(path)
+    index = CorpusIndex.load(path)
+    assert index.candidates('//Tree[node="left"]') == {0, 1, 2}
+
+    data = [{'name': 'x{}'.format(i)} for i in range(10)]
+    index = build_index(data)
+    res = list(xquery_corpus(data, '//name[text()="x3"]', index=index, max_workers=1))
+    assert res == [(3, ['x3'])]
+
+    other = Hiccup()
+    other.exclude(IfName('name'))
+    with pytest.raises(HiccupError, match='different'):
+        list(xquery_corpus(data, '//name', hiccup=other, index=index, max_workers=1))
+
+    # text() in the predicate of a filter expression refers to c, not b
+    class B:
+        def __init__(self) -> None:
+            self.c = 'x'
+
+    data = [{'b': B()}]
+    query = '//b[(c)[text()="x"]]'
+    assert len(Hiccup().xquery(data[0], query)) == 1
+    assert build_index(data).candidates(query) == {0}
+
+    # node() isn't an element called 'node'
+    data = [Tree('a'), {'x': 'left'}]
+    query = '//node()[text()="left"]'
+    assert len(Hiccup().xquery(data[1], query)) == 1
+    assert 1 in build_index(data).candidates(query)
+
+    # the index sees the same xml as queries, i.e. after xml_hook
+    h = Hiccup()
+    h.xml_hook = rename_x
+    data = [{'x': 'value'}]
+    index = build_index(data, hiccup=h)
+    assert index.candidates('//renamed') == {0}
+    assert index.candidates('//x') == set()
+    with pytest.raises(HiccupError, match='different'):
+        list(xquery_corpus(data, '//renamed', index=index, max_workers=1))
+    assert list(xquery_corpus(data, '//renamed', hiccup=h, index=index, max_workers=1)) == [(0, ['value'])]
+
+
+def test_value_index():
+    class Todo:
+        def __init__(self, title, tags) -> None:
+            self.title = title
+            self.tags = tags
+
+    todos = [Todo('TODO {}'.format(i) if i % 3 == 0 else 'item {}'.format(i), ['x', str(i % 2)]) for i in range(20)]
+    # empty text is still a text node
+    todos.append(Todo('', ['x']))
+    queries = [
+        '//Todo',
+        '//title[text()="item 4"]',
+        '//*[text()="1"]',
+        '//title[starts-with(text(), "TODO")]',
+        "//primitivish[starts-with(text(), '')]",
+        '//title[text()=""]',
+        '//title[starts-with(text(), "")]',
+        '//missing[text()="x"]',
+        '//Todo[./title[text()="item 4"]]', # not indexed
+    ]
+    plain = Hiccup()
+    indexed = Hiccup()
+    indexed.value_index = True
+    with plain.snapshot(todos) as ps, indexed.snapshot(todos) as ins:
+        for q in queries:
+            assert ins.xquery(q) == ps.xquery(q), q
+        assert ins.xquery('//title[starts-with(text(), "TODO")]', limit=2) == ['TODO 0', 'TODO 3']
+
+        todos[4].title = 'TODO later'
+        ins.mark_dirty(todos[4])
+        ins.refresh()
+        assert ins.xquery('//title[text()="item 4"]') == []
+        assert ins.xquery_single('//Todo[./title[text()="TODO later"]]') is todos[4]
+        assert len(ins.xquery('//title[starts-with(text(), "TODO")]')) == 8
+
+
+def test_stats():
+    import time
+
+    class Slow:
+        def __init__(self) -> None:
+            self.secret = 'xxx'
+            self.value = 1
+
+        @property
+        def expensive(self):
+            time.sleep(0.01)
+            return 'slow'
+
+    h = Hiccup()
+    h.exclude(IfName('secret'))
+    h.exclude(IfValueMatches(lambda x: x == 1))
+    exported = []
+    h.stats_hook = lambda s: exported.append(s.as_dict())
+
+    objs = [Slow(), Slow()]
+    res, stats = h.xquery_stats(objs, '//expensive')
+    assert res == ['slow', 'slow']
+    assert stats.elements == 5
+    assert stats.attributes == 2
+    assert stats.queries == 1
+    assert stats.rule_hits["IfName('secret')"] == 2
+    assert stats.rule_hits['IfValueMatches(<lambda>)'] == 2
+    assert stats.rule_hits["IfNameMatches('__.*')"] > 0 # default rules
+    assert stats.excluded == sum(stats.rule_hits.values())
+    assert stats.slowest_attributes(1)[0][0] == ('Slow', 'expensive')
+    assert stats.getattrs[('Slow', 'expensive')][0] == 2
+    assert stats.by_type()['Slow'] >= 0.02
+    assert {'convert', 'members', 'getattr', 'exclusion', 'xpath', 'map'}.issubset(stats.phases)
+
+    assert len(exported) == 1
+    assert exported[0]['elements'] == 5
+
+    # not collected unless asked for
+    assert h.xquery(objs, '//expensive') == ['slow', 'slow']
+    assert len(exported) == 1
+    h.profile = True
+    with h.snapshot(objs) as snap:
+        snap.xquery('//Slow')
+        snap.xquery('//Slow')
+        assert snap.stats.queries == 2
+    assert len(exported) == 2
+
+
+def test_memoize():
+    import gc
+    calls = []
+
+    class Parsed:
+        def __init__(self, text) -> None:
+            self.text = text
+
+        @property
+        def words(self):
+            calls.append(self.text)
+            return self.text.split()
+
+        @property
+        def length(self):
+            calls.append('length')
+            return len(self.text)
+
+    h = Hiccup()
+    with pytest.raises(HiccupError):
+        h.memoize(IfValueMatches(lambda x: True))
+    h.memoize(IfParentType(Parsed), IfName('words'))
+
+    objs = [Parsed('a b'), Parsed('c')]
+    assert h.xquery(objs, '//words/primitivish') == ['a', 'b', 'c']
+    assert h.xquery(objs, '//words/primitivish') == ['a', 'b', 'c']
+    assert calls == ['length', 'a b', 'length', 'c', 'length', 'length']
+    assert h.value_cache.hits == 2
+    assert len(h.value_cache) == 2
+
+    objs[0].text = 'x y'
+    h.value_cache.invalidate(objs[0])
+    assert h.xquery(objs, '//words/primitivish') == ['x', 'y', 'c']
+
+    del objs
+    gc.collect()
+    assert len(h.value_cache) == 0
+
+    h.value_cache = ValueCache(maxsize=1, ttl=0)
+    objs = [Parsed('a'), Parsed('b')]
+    h.xquery(objs, '//words')
+    assert len(h.value_cache) == 1
+    h.xquery(objs, '//words')
+    assert h.value_cache.hits == 0
+
+
+def test_typed_dispatch():
+    from hiccup import DefaultListFactory
+
+    class Bag:
+        def __init__(self) -> None:
+            self.items = ('a', 1, None, 1.5, True)
+            self.mapping = {'key': {'nested'}}
+            self.method = self.__init__
+
+    obj = [Bag(), Bag()]
+    h = Hiccup()
+    assert h._typed_dispatch()
+    expected = ET.tostring(h.as_xml(obj))
+
+    class Listish(DefaultListFactory):
+        pass
+
+    h.list_factory = Listish()
+    assert not h._typed_dispatch()
+    assert ET.tostring(h.as_xml(obj)) == expected
+
+
+def test_fields_only():
+    from collections import namedtuple
+    dataclasses = pytest.importorskip('dataclasses')
+
+    @dataclasses.dataclass
+    class Item:
+        name: str
+        count: int = 0
+
+        def total(self) -> int:
+            return self.count * 2
+
+        @property
+        def label(self) -> str:
+            return self.name.upper()
+
+    class Slotted:
+        __slots__ = ('x', '__y', 'unset')
+
+        def __init__(self) -> None:
+            self.x = 1
+            self.__y = 2
+
+    Pair = namedtuple('Pair', ['left', 'right'])
+
+    obj = [Item('apple', 3), Slotted(), Pair('l', 'r')]
+    h = Hiccup()
+    h.python_id_attr = None # properties return new objects each time
+    regular = ET.tostring(h.as_xml(obj[:2]))
+    h.fields_only = True
+    assert ET.tostring(h.as_xml(obj[:2])) == regular
+
+    assert h.xquery(obj, '//Item/label') == ['APPLE']
+    assert h.xquery(obj, '//Slotted/_Slotted__y') == [2]
+    assert h.xquery(obj, '//Pair/*') == ['l', 'r']
+
+    h.field_properties = False
+    assert [x.tag for x in h.as_xml(obj)[0]] == ['count', 'name']
+
+
+def test_compact_sequences():
+    import array
+
+    class Sensor:
+        def __init__(self) -> None:
+            self.name = 'thermo'
+            self.readings = [float(x) for x in range(1000)]
+            self.raw = array.array('i', [5, 3, 9])
+            self.mixed = [1, 'a', 2.0]
+
+    s = Sensor()
+    h = Hiccup()
+    h.compact_sequences = 3
+    xml = h.as_xml(s)
+    readings = xml.find('readings')
+    assert len(readings) == 0
+    assert {k: readings.get(k) for k in ['length', 'itemtype', 'min', 'max']} == {'length': '1000', 'itemtype': 'float', 'min': '0.0', 'max': '999.0'}
+    assert xml.find('raw').get('max') == '9'
+    assert len(xml.find('mixed')) == 3
+
+    with h.snapshot(s) as snap:
+        assert snap.xquery('//readings') == [s.readings]
+        assert snap.xquery('//Sensor[hiccup:item(readings, 2) = 1]') == [s]
+        assert snap.xquery('//raw[hiccup:item(., 3) > 6]') == [s.raw]
+        assert snap.xquery('//raw[hiccup:item(., 4)]') == []
+
+        # items are looked up live, summary is refreshed
+        s.raw[0] = 100
+        assert snap.refresh(detect=True) == 1
+        assert snap.xml.find('raw').get('max') == '100'
+        assert snap.xquery('//raw[hiccup:item(., 1) = 100]') == [s.raw]
+        assert snap.refresh(detect=True) == 0
+
+    h.compact_sequences = None
+    assert len(h.as_xml(s).find('readings')) == 1000
+
+
+def test_budget():
+    from hiccup import Budget
+
+    class Node:
+        def __init__(self, value: int, child) -> None:
+            self.value = value
+            self.child = child
+
+    deep = None
+    for i in range(100):
+        deep = Node(i, deep)
+    wide = {'items': list(range(1000))}
+
+    h = Hiccup()
+    h.budget = Budget(max_depth=5)
+    with pytest.raises(HiccupError, match='depth'):
+        h.as_xml(deep)
+
+    h.budget = Budget(max_depth=5, partial=True)
+    with h.snapshot(deep) as snap:
+        assert snap.truncated
+        assert len(snap.xml.xpath('//*[@_truncated="depth"]')) == 1
+        assert snap.xquery('//value') == [96, 97, 98, 99]
+        assert snap.refresh(detect=True) == 0
+
+    h.budget = Budget(max_items=10, partial=True)
+    xml = h.as_xml(wide)
+    assert len(xml.find('items')) == 10
+    assert xml.find('items').get('_truncated') == 'items'
+
+    h.budget = Budget(max_nodes=50, partial=True)
+    with h.snapshot(wide) as snap:
+        assert snap.truncated
+        assert len(snap.xml.xpath('//*')) == 50
+        assert [x.tag for x in snap.xml.xpath('//*[@_truncated]')] == ['items']
+
+    h.budget = Budget(deadline=0.0, partial=True)
+    with h.snapshot(deep) as snap:
+        assert snap.truncated
+        assert snap.xml.get('_truncated') == 'deadline'
+
+    h.budget = Budget(max_nodes=10000, deadline=60)
+    with h.snapshot(wide) as snap:
+        assert not snap.truncated
+
+
+def test_classes_collected():
+    import gc
+    import weakref
+
+    h = Hiccup()
+    h.memoize(IfName('x'))
+
+    def make():
+        cls = type('Temp', (), {})
+        obj = cls()
+        obj.x = 1
+        assert h.xquery(obj, '//x') == [1]
+        return weakref.ref(cls)
+
+    ref = make()
+    gc.collect()
+    assert ref() is None